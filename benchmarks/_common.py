@@ -0,0 +1,95 @@
+"""基准脚本共用的部分：临时目录里的应用、批量造数据、统计 SQL 语句数和耗时。"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+
+from blogs import create_app  # noqa: E402
+from blogs.extensions import db  # noqa: E402
+from blogs.models.blogs import Role, Status, User, Forum, Topic, Post  # noqa: E402
+from blogs.models.tecon import Series  # noqa: E402
+from blogs.settings import config, TestingConfig  # noqa: E402
+
+PASSWORD = '12345678'
+
+
+def make_app(**settings):
+    tmp = tempfile.mkdtemp()
+
+    class Config(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        UPLOAD_PATH = os.path.join(tmp, 'files')
+        AVATARS_SAVE_PATH = os.path.join(tmp, 'avatars')
+        TECON_PATH = os.path.join(tmp, 'tecon')
+        WHOOSHEE_MEMORY_STORAGE = True
+        FRAGMENT_CACHE_SIZE = 0
+        PAGE_CACHE_SIZE = 0
+
+    for key, value in settings.items():
+        setattr(Config, key, value)
+    for path in (Config.UPLOAD_PATH, Config.AVATARS_SAVE_PATH, Config.TECON_PATH):
+        os.mkdir(path)
+    config['bench'] = Config
+    app = create_app('bench')
+    with app.app_context():
+        db.create_all()
+        Role.init_role()
+        Status.init_status()
+        Series.init_series()
+        admin = User(username='admin', name='admin', email='admin@example.com', confirmed=True)
+        admin.set_password(PASSWORD)
+        admin.role = Role.query.filter_by(name='管理员').first()
+        db.session.add(admin)
+        for i in range(1, 4):
+            db.session.add(Forum(name='group%d' % i, intro='', admin=admin, status_id=4))
+        db.session.commit()
+    return app
+
+
+def add_topics(group_id, author_id, count, posts_per_topic=0):
+    """用批量插入给 group_id 造 count 个主题，每个主题 posts_per_topic 条回帖，返回新主题的 id。"""
+    start = datetime.utcnow() - timedelta(days=30)
+    first_id = (db.session.query(db.func.max(Topic.id)).scalar() or 0) + 1
+    db.session.bulk_insert_mappings(Topic, [
+        dict(id=first_id + i, name='topic %d' % i, body='body', group_id=group_id, author_id=author_id,
+             timestamp=start + timedelta(seconds=i), post_count=posts_per_topic,
+             saved=False, deleted=False, top=False) for i in range(count)])
+    db.session.bulk_insert_mappings(Post, [
+        dict(title='post', body='reply', topic_id=first_id + i, author_id=author_id,
+             timestamp=start + timedelta(seconds=i, milliseconds=j + 1), saved=False, deleted=False)
+        for i in range(count) for j in range(posts_per_topic)])
+    last_post = db.session.query(db.func.max(Post.id)).filter(Post.topic_id == Topic.id).as_scalar()
+    Topic.query.filter(Topic.id >= first_id).update({Topic.last_post_id: last_post}, synchronize_session=False)
+    db.session.commit()
+    return list(range(first_id, first_id + count))
+
+
+class Measure(object):
+    """with Measure(engine) as m: ... 之后 m.queries 是执行的语句数，m.seconds 是耗时。"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.queries = 0
+        self.seconds = 0.0
+
+    def _count(self, *args):
+        self.queries += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._start
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
@@ -0,0 +1,42 @@
+"""重新统计小组最后回帖和回帖数（删帖、举报和 flask get-last 里用到）的耗时和内存随小组大小的变化。
+
+    python benchmarks/group_aggregates.py
+"""
+import tracemalloc
+
+from _common import make_app, add_topics, Measure, median, db, Forum
+
+GROUP_SIZES = (1000, 5000, 20000)
+POSTS_PER_TOPIC = 2
+ROUNDS = 5
+
+
+def measure(engine, func):
+    timings, queries, peaks = [], 0, []
+    for _ in range(ROUNDS):
+        db.session.expire_all()  # 每轮都从数据库重新加载，不吃会话里的缓存
+        tracemalloc.start()
+        with Measure(engine) as m:
+            func()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        timings.append(m.seconds)
+        queries = m.queries
+    return median(timings) * 1000, queries, max(peaks) / 1024.0
+
+
+def main():
+    print('%-8s %-16s %10s %8s %10s' % ('topics', 'method', 'median ms', 'queries', 'peak KiB'))
+    for size in GROUP_SIZES:
+        app = make_app()
+        with app.app_context():
+            add_topics(1, 1, size, posts_per_topic=POSTS_PER_TOPIC)
+            engine = db.engine
+            group = Forum.query.get(1)
+            for name in ('get_last_post', 'get_post_count'):
+                ms, queries, peak = measure(engine, getattr(group, name))
+                print('%-8d %-16s %10.1f %8d %10.0f' % (size, name, ms, queries, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""小组主题列表页的 SQL 语句数和耗时随每页主题数的变化。
+
+已读状态一次 IN 查询取出，回帖数用 Topic.post_count，语句数应当和每页条数无关：
+
+    python benchmarks/group_page.py
+"""
+from _common import make_app, add_topics, Measure, median, PASSWORD, db, User, Topic
+
+PAGE_SIZES = (10, 20, 50, 100)
+ROUNDS = 20
+
+
+def main():
+    app = make_app()
+    with app.app_context():
+        admin = User.query.filter_by(username='admin').one()
+        topic_ids = add_topics(1, admin.id, 300, posts_per_topic=3)
+        Topic.query.filter(Topic.id.in_(topic_ids[:3])).update({'top': True}, synchronize_session=False)
+        db.session.commit()
+        for topic_id in topic_ids[::2]:  # 一半主题看过
+            admin.read(Topic.query.get(topic_id))
+        engine = db.engine
+
+    client = app.test_client()
+    client.post('/auth/login', data=dict(username='admin', password=PASSWORD))
+    client.get('/group/1')  # 先把导航缓存填上
+    print('%-10s %8s %12s' % ('per_page', 'queries', 'median ms'))
+    for per_page in PAGE_SIZES:
+        app.config['TOPIC_PER_PAGE'] = per_page
+        counts, timings = set(), []
+        for _ in range(ROUNDS):
+            with Measure(engine) as m:
+                assert client.get('/group/1').status_code == 200
+            counts.add(m.queries)
+            timings.append(m.seconds)
+        print('%-10d %8s %12.1f' % (per_page, '/'.join(map(str, sorted(counts))), median(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 import os
+import time
+from datetime import datetime, timedelta
 import click
 import logging
 from logging.handlers import RotatingFileHandler, SMTPHandler
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, abort
 from flask_wtf.csrf import CSRFError
 from flask_login import current_user
 
@@ -15,8 +17,16 @@ from blogs.blueprints.auth import auth_bp
 from blogs.blueprints.admin import admin_bp
 from blogs.blueprints.user import user_bp
 from blogs.blueprints.tecon import view_bp
-from blogs.models.blogs import Post, File, User, Role, Topic, Notification, Status, Forum
-from blogs.models.tecon import Series, Item
+from blogs.models.blogs import Post, File, User, Role, Topic, Status, Forum, ReadMark, \
+    Notification, NotificationArchive
+from blogs.models.tecon import Series
+from blogs.caches import get_nav_items, get_group_info, fragment_cache, page_cache
+from blogs.counters import view_counter, MemoryStore
+from blogs import storage
+from blogs.images import image_service
+from blogs.emails import mail_queue, send_digest_emails
+from blogs.events import notification_hub
+from blogs.utils import dedupe_attachments, find_orphan_uploads
 
 basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 
@@ -54,6 +64,13 @@ def register_extensions(app):
     ckeditor.init_app(app)
     whooshee.init_app(app)
     dropzone.init_app(app)
+    view_counter.init_app(app)
+    fragment_cache.init_app(app)
+    page_cache.init_app(app)
+    storage.init_app(app)
+    image_service.init_app(app)
+    mail_queue.init_app(app)
+    notification_hub.init_app(app)
 
     @login_manager.user_loader
     def load_user(user_id):
@@ -133,12 +150,13 @@ def register_template_context(app):
     @app.context_processor
     def make_template_context():
         if current_user.is_authenticated:
-            notification_count = Notification.query.with_parent(current_user).filter_by(is_read=False).count()
+            notification_count = current_user.unread_notification_count
         else:
             notification_count = None
-        introduces = Item.query.filter_by(saved=False, series_id=1).order_by(Item.name).all()
-        products = Item.query.filter_by(saved=False, series_id=2).order_by(Item.name).all()
-        group3 = Forum.query.get_or_404(3)
+        introduces, products = get_nav_items()  # 导航菜单和3号组信息走缓存，Item/Forum有写入时失效
+        group3 = get_group_info(3)
+        if group3 is None:
+            abort(404)
         return dict(notification_count=notification_count, introduces=introduces, products=products, group3=group3)
 
 
@@ -254,6 +272,7 @@ def register_commands(app):
             else:
                 forum.last_post_id = None
                 forum.post_count = 0
+            forum.refresh_last_activity()
             db.session.commit()
         topics = Topic.query.all()
         for topic in topics:
@@ -271,6 +290,124 @@ def register_commands(app):
             db.session.commit()
         click.echo('Get last Done.')
 
+    @app.cli.command()
+    def flush_view_counts():
+        """Write buffered topic view counts to the database."""
+        if isinstance(view_counter.store, MemoryStore):
+            # 命令行是单独的进程，内存缓冲是空的，web 进程的计数只能由它们自己写回
+            raise click.ClickException('flush-view-counts needs VIEW_COUNTER_STORE = "redis"; '
+                                       'with the memory store each web process flushes its own counts.')
+        count = view_counter.flush()
+        click.echo('Flushed view counts of %d topics.' % count)
+
+    @app.cli.command()
+    def create_indexes():
+        """Create indexes declared on the models that are missing in the database."""
+        inspector = db.inspect(db.engine)
+        for table in db.metadata.tables.values():
+            existing = set(index['name'] for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=db.engine)
+                    click.echo('Created %s.' % index.name)
+        click.echo('Done.')
+
+    @app.cli.command()
+    def repair_notification_count():
+        """Recompute every user's unread notification count."""
+        count = User.repair_unread_count()
+        click.echo('Repaired %d users.' % count)
+
+    @app.cli.command()
+    def dedupe_files():
+        """Hash existing attachments and merge duplicates into shared blobs."""
+        linked, removed = dedupe_attachments()
+        click.echo('Linked %d attachments, removed %d duplicate files.' % (linked, removed))
+
+    @app.cli.command()
+    @click.option('--batch-size', default=1000, help='Quantity of notifications converted per commit, default is 1000.')
+    def convert_notifications(batch_size):
+        """Convert pre-rendered notifications into structured, coalesced ones."""
+        converted, removed = Notification.convert_messages(batch_size)
+        click.echo('Converted %d notifications, merged away %d duplicates.' % (converted, removed))
+
+    @app.cli.command()
+    @click.option('--days', default=90, help='Purge read notifications older than this many days, default is 90.')
+    @click.option('--batch-size', default=1000, help='Quantity of notifications removed per transaction, default is 1000.')
+    @click.option('--pause', default=0.0, help='Seconds to sleep between batches, default is 0.')
+    @click.option('--archive', is_flag=True, help='Copy purged notifications into notification_archive first.')
+    def purge_notifications(days, batch_size, pause, archive):
+        """Purge or archive old read notifications in small batches."""
+        if archive:
+            NotificationArchive.__table__.create(db.engine, checkfirst=True)
+        before = datetime.utcnow() - timedelta(days=days)
+        total = 0
+        while True:
+            count = Notification.purge_read(before, batch_size, archive)
+            if not count:
+                break
+            total += count
+            time.sleep(pause)
+        click.echo('%s %d notifications.' % ('Archived' if archive else 'Purged', total))
+
+    @app.cli.command()
+    def convert_views():
+        """Backfill topic activity times and convert legacy View rows into read marks."""
+        count = ReadMark.convert_views()
+        click.echo('Converted %d read records.' % count)
+
+    @app.cli.command()
+    @click.option('--batch-size', default=1000, help='Quantity of read marks removed per transaction, default is 1000.')
+    @click.option('--pause', default=0.0, help='Seconds to sleep between batches, default is 0.')
+    def prune_read_marks(batch_size, pause):
+        """Remove read marks older than READ_MARK_DAYS in small batches."""
+        total = 0
+        while True:
+            count = ReadMark.prune(batch_size)
+            if not count:
+                break
+            total += count
+            time.sleep(pause)
+        click.echo('Pruned %d read marks.' % total)
+
+    @app.cli.command()
+    @click.option('--batch-size', default=1000, help='Quantity of files moved per batch, default is 1000.')
+    @click.option('--pause', default=0.0, help='Seconds to sleep between batches, default is 0.')
+    def migrate_uploads(batch_size, pause):
+        """Move flat upload files into hashed subdirectories."""
+        for path_key in storage.STORAGE_KEYS:
+            total = 0
+            while True:
+                moved = storage.migrate(path_key, batch_size)
+                if not moved:
+                    break
+                total += moved
+                click.echo('%s: moved %d files...' % (path_key, total))
+                time.sleep(pause)
+            click.echo('%s: done, %d files moved.' % (path_key, total))
+
+    @app.cli.command()
+    @click.option('--grace-days', default=7, help='Only files untouched for this many days are collected, default is 7.')
+    @click.option('--batch-size', default=500, help='Quantity of files checked per query, default is 500.')
+    @click.option('--delete', is_flag=True, help='Delete the orphaned files instead of only listing them.')
+    def gc_uploads(grace_days, batch_size, delete):
+        """List or delete uploaded files that nothing references."""
+        for path_key in storage.STORAGE_KEYS:
+            count = 0
+            for orphan in find_orphan_uploads(path_key, grace_days * 24 * 3600, batch_size):
+                click.echo('%s %s' % (path_key, orphan.location))
+                if delete:
+                    storage.discard(path_key, orphan.location)
+                count += 1
+            click.echo('%s: %d orphaned files %s.' % (path_key, count, 'deleted' if delete else 'found'))
+
+    @app.cli.command()
+    def send_digests():
+        """Email new-reply digests to subscribers who chose digest mode."""
+        with app.test_request_context(base_url=app.config['SITE_URL']):
+            count = send_digest_emails(app.config['NOTICE_DIGEST_WINDOW'])
+        click.echo('Sent %d digests.' % count)
+
 
 def register_shell_context(app):
     @app.shell_context_processor
@@ -1,8 +1,11 @@
-from flask import Blueprint, jsonify, render_template
+from flask import Blueprint, Response, jsonify, render_template, current_app, abort
 from flask_login import current_user
 
-from blogs.models.blogs import User, Notification
 from blogs.extensions import db
+from blogs.models.blogs import User, Notification
+from blogs.images import image_service
+from blogs.emails import mail_queue
+from blogs.events import notification_hub, publish_unread_count
 
 ajax_bp = Blueprint('ajax', __name__)
 
@@ -20,8 +23,23 @@ def notifications_count():
     if not current_user.is_authenticated:
         return jsonify(message='请先登录'), 403
 
-    count = Notification.query.with_parent(current_user).filter_by(is_read=False).count()
-    return jsonify(count=count)
+    return jsonify(count=current_user.unread_notification_count)
+
+
+@ajax_bp.route('/notifications-stream')
+def notifications_stream():
+    if not current_app.config['NOTIFY_STREAM']:
+        abort(404)  # 同步 worker 下不能让连接挂住请求线程，页面改用轮询
+    if not current_user.is_authenticated:
+        return jsonify(message='请先登录'), 403
+    # 先订阅再读当前的数，两者之间的变化不会漏掉
+    subscription = notification_hub.subscribe(current_user.id)
+    count = db.session.query(User.unread_notification_count).filter_by(id=current_user.id).scalar()
+    # 生成器里不用应用上下文，请求结束时数据库连接照常归还，长连接不占连接池
+    response = Response(notification_hub.stream(subscription, count), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(lambda: notification_hub.unsubscribe(subscription))
+    return response
 
 
 @ajax_bp.route('/notification/read/<int:notification_id>', methods=['POST'])
@@ -32,8 +50,26 @@ def read_notice(notification_id):
     if current_user != notification.receiver:
         return jsonify(message='无权操作'), 403
     if not notification.is_read:
-        notification.is_read = True
-        db.session.commit()
-        return jsonify(message='通知已读')
-    else:
-        return jsonify(message='通知已读')
\ No newline at end of file
+        current_user.read_notification(notification)
+        publish_unread_count(current_user)
+    return jsonify(message='通知已读')
+
+@ajax_bp.route('/image-stats')
+def image_stats():
+    if not current_user.can('ADMINISTER'):
+        return jsonify(message='无权操作'), 403
+    return jsonify(image_service.stats())  # 本进程的图片处理排队数和耗时
+
+
+@ajax_bp.route('/mail-stats')
+def mail_stats():
+    if not current_user.can('ADMINISTER'):
+        return jsonify(message='无权操作'), 403
+    return jsonify(mail_queue.stats())  # 本进程的发信队列长度和发送统计
+
+
+@ajax_bp.route('/notify-stats')
+def notify_stats():
+    if not current_user.can('ADMINISTER'):
+        return jsonify(message='无权操作'), 403
+    return jsonify(notification_hub.stats())  # 本进程挂着的通知推送连接数
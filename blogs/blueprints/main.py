@@ -1,6 +1,5 @@
-from flask import render_template, Blueprint, send_from_directory, current_app, request, redirect, url_for, abort, flash
+from flask import render_template, Blueprint, current_app, request, redirect, url_for, abort, flash
 from flask_login import current_user, login_required
-import os
 import time
 from flask_ckeditor import upload_success, upload_fail
 import uuid
@@ -9,22 +8,34 @@ from datetime import datetime
 from blogs.models.blogs import File, Post, Forum, User, Notification, Topic, Collect
 from blogs.extensions import db
 from blogs.forms.main import PostForm
-from blogs.utils import redirect_back, resize_image, rename_image
+from blogs.utils import redirect_back, resize_image, rename_image, send_upload, save_attachment, \
+    resize_variants
+from blogs.pagination import keyset_paginate
+from blogs import storage
+from blogs.counters import view_counter
+from blogs.events import publish_unread_count
 from blogs.noticifations import push_post_notification, push_collect_notification, push_notice_notification, \
     push_max_reported_post_notification, push_max_reported_topic_notification
-from blogs.decorators import permission_required, confirm_required
-from blogs.emails import send_new_post_email
+from blogs.decorators import permission_required, confirm_required, cache_page
+from blogs.emails import send_new_post_emails
 from blogs.forms.admin import MigrateForm
 
 main_bp = Blueprint('main', __name__)
 
 
+def index_state():
+    # 首页的组列表只取决于各组的 version，一条只读两列的查询，不用载入整个组
+    return tuple(Forum.query.with_entities(Forum.id, Forum.version).order_by(Forum.id))
+
+
 @main_bp.route('/')
+@cache_page(private=index_state)
 def index():
-    all_groups = Forum.query.filter_by(status_id=4).all()
-    apart_groups = Forum.query.filter_by(status_id=3).all()
-    limit_groups = Forum.query.filter_by(status_id=2).all()
-    member_groups = Forum.query.filter_by(status_id=1).all()
+    # 一次查询取出所有组，最后动态已冗余在组里，再按状态分到各个区
+    groups = {1: [], 2: [], 3: [], 4: []}
+    for group in Forum.query.order_by(Forum.id).all():
+        groups.setdefault(group.status_id, []).append(group)
+    all_groups, apart_groups, limit_groups, member_groups = groups[4], groups[3], groups[2], groups[1]
     return render_template('main/index.html', all_groups=all_groups, limit_groups=limit_groups,
                            groups=apart_groups, member_groups=member_groups)
 
@@ -72,10 +83,9 @@ def new_topic(group_id):
 
 
 @main_bp.route('/show_topic/<int:topic_id>')
+@cache_page(on_hit=view_counter.incr)
 def show_topic(topic_id):
     topic = Topic.query.get_or_404(topic_id)
-    topic.read_time += 1
-    db.session.commit()
     if topic.saved and current_user != topic.author and not current_user.can('MODERATE'):
         abort(404)
     if topic.deleted and not current_user.can('MODERATE'):
@@ -91,13 +101,14 @@ def show_topic(topic_id):
     if not current_user.can('MEMBER') and topic.group.status_id == 1:
         abort(403)
 
-    page = request.args.get('page', 1, type=int)
+    view_counter.incr(topic.id)  # 浏览数先记在缓冲里，定期批量写回
+    if current_user.is_authenticated:
+        current_user.read(topic)  # 会提交事务，放在加载回帖之前，免得回帖过期后逐条重新查询
     per_page = current_app.config['POST_PER_PAGE']
-    pagination = Post.query.with_parent(topic).filter_by(saved=False).filter_by(deleted=False).\
-        order_by(Post.timestamp.asc()).paginate(page, per_page)
+    pagination = keyset_paginate(Post.query.with_parent(topic).options(db.selectinload(Post.files)).
+                                 filter_by(saved=False).filter_by(deleted=False),
+                                 Post.timestamp, Post.id, per_page, descending=False)
     posts = pagination.items
-    if current_user.is_authenticated:
-        current_user.read(topic)
     form = MigrateForm()
     return render_template('main/show_topic.html', topic=topic, posts=posts, pagination=pagination, form=form)
 
@@ -123,9 +134,8 @@ def new_post(topic_id):
             db.session.commit()
             topic.last_post_id = topic.group.last_post_id = post.id
             db.session.commit()
-            if topic.receivers:
-                for notice in topic.receivers:
-                    send_new_post_email(receiver=notice.receiver, topic=topic, user=current_user)
+            current_user.read(topic)  # 自己的回帖不算新回复
+            send_new_post_emails(topic, current_user)
             if form.notice.data:
                 current_user.notice(topic)
             if current_user != topic.author and topic.author.receive_post_notification:
@@ -148,7 +158,7 @@ def new_post(topic_id):
 
 @main_bp.route('/uploads/<path:filename>')
 def get_file(filename):
-    return send_from_directory(current_app.config['UPLOAD_PATH'], filename)
+    return send_upload('UPLOAD_PATH', filename)
 
 
 @main_bp.route('/upload', methods=['POST'])
@@ -158,15 +168,19 @@ def upload():
     if extension not in ['jpg', 'gif', 'png', 'jpeg']:  # 验证文件类型示例
         return upload_fail(message='只能上传图片！')  # 返回upload_fail调用
     filename = uuid.uuid4().hex + '.' + extension
-    if os.path.exists(os.path.join(current_app.config['UPLOAD_PATH'], filename)):
+    if storage.exists('UPLOAD_PATH', filename):
         filename = rename_image(filename)
-    f.save(os.path.join(current_app.config['UPLOAD_PATH'], filename))
-    resize_image(request.files['upload'], filename, current_app.config['PHOTO_SIZE']['medium'])
+    storage.save('UPLOAD_PATH', filename, f)
+    if extension == 'gif':
+        filename = resize_image(filename, current_app.config['PHOTO_SIZE']['medium'])  # 正文引用缩略图
+    else:
+        resize_variants(filename)  # 多种宽度和 WebP 版本，保存正文时写进 srcset
     url = url_for('.get_file', filename=filename)
     return upload_success(url, filename) # 返回upload_success调用
 
 
 @main_bp.route('/post/<int:post_id>', methods=['POST', 'GET'])
+@cache_page()
 def show_post(post_id):
     post = Post.query.get_or_404(post_id)
     if post.saved and current_user != post.author and not current_user.can('MODERATE'):
@@ -187,7 +201,7 @@ def show_post(post_id):
 
 @main_bp.route('/avatars/<path:filename>')
 def get_avatar(filename):
-    return send_from_directory(current_app.config['AVATARS_SAVE_PATH'], filename)
+    return send_upload('AVATARS_SAVE_PATH', filename)
 
 
 @main_bp.route('/post/<int:post_id>/d', methods=['POST'])
@@ -283,10 +297,11 @@ def delete_topic(topic_id):
 @main_bp.route('/notifications')
 @login_required
 def show_notifications():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['NOTIFICATION_PER_PAGE']
-    notifications = Notification.query.with_parent(current_user)
-    pagination = notifications.order_by(Notification.timestamp.desc()).paginate(page, per_page)
+    notifications = Notification.query.with_parent(current_user).\
+        options(db.joinedload(Notification.actor), db.joinedload(Notification.topic),
+                db.joinedload(Notification.post), db.joinedload(Notification.group))
+    pagination = keyset_paginate(notifications, Notification.timestamp, Notification.id, per_page)
     notifications = pagination.items
     return render_template('main/notifications.html', pagination=pagination, notifications=notifications)
 
@@ -298,8 +313,8 @@ def read_notification(notification_id):
     if current_user != notification.receiver:
         abort(403)
 
-    notification.is_read = True
-    db.session.commit()
+    current_user.read_notification(notification)
+    publish_unread_count(current_user)
     flash('通知已读。', 'success')
     return redirect(url_for('.show_notifications'))
 
@@ -307,9 +322,8 @@ def read_notification(notification_id):
 @main_bp.route('/notifications/read/all', methods=['POST'])
 @login_required
 def read_all_notification():
-    for notification in current_user.notifications:
-        notification.is_read = True
-    db.session.commit()
+    current_user.read_all_notifications()
+    publish_unread_count(current_user)
     flash('所有通知已读', 'success')
     return redirect(url_for('.show_notifications'))
 
@@ -338,9 +352,8 @@ def reply_post(replied_id):
             db.session.commit()
             replied.topic.last_post_id = replied.topic.group.last_post_id = post.id
             db.session.commit()
-            if post.topic.receivers:
-                for notice in post.topic.receivers:
-                    send_new_post_email(receiver=notice.receiver, topic=post.topic, user=current_user)
+            current_user.read(replied.topic)  # 自己的回帖不算新回复
+            send_new_post_emails(post.topic, current_user)
             if form.notice.data:
                 current_user.notice(post.topic)
             if current_user != post.topic.author and post.topic.author.receive_post_notification:
@@ -396,6 +409,7 @@ def uncollect(topic_id):
 
 
 @main_bp.route('/group/<int:group_id>')
+@cache_page()
 def show_group(group_id):
     group = Forum.query.get_or_404(group_id)
 
@@ -410,12 +424,29 @@ def show_group(group_id):
     if not current_user.can('MEMBER') and group.status_id == 1:
         abort(403)
 
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['TOPIC_PER_PAGE']
-    pagination = Topic.query.with_parent(group).filter_by(saved=False, top=False, deleted=False).\
-        order_by(Topic.timestamp.desc()).paginate(page, per_page)
+    # 作者和最后回帖随主题一起加载，已读状态一次查询取出，模板里不再逐行查询
+    options = Topic.list_options()
+    pagination = keyset_paginate(Topic.query.with_parent(group).options(*options).
+                                 filter_by(saved=False, top=False, deleted=False),
+                                 Topic.timestamp, Topic.id, per_page)
     topics = pagination.items
-    return render_template('main/group.html', topics=topics, pagination=pagination, group=group)
+    top_topics = group.top_topic(*options)
+    if current_user.is_authenticated:
+        read_states = current_user.read_states([topic.id for topic in top_topics + topics])
+    else:
+        read_states = {}
+    return render_template('main/group.html', topics=topics, top_topics=top_topics, pagination=pagination,
+                           group=group, read_states=read_states)
+
+
+@main_bp.route('/group/<int:group_id>/read', methods=['POST'])
+@login_required
+def read_group(group_id):
+    group = Forum.query.get_or_404(group_id)
+    current_user.read_group(group)
+    flash('本组主题已全部标为已读', 'success')
+    return redirect(url_for('main.show_group', group_id=group_id))
 
 
 @main_bp.route('/post/<int:post_id>/edit', methods=['GET', 'POST'])
@@ -442,9 +473,7 @@ def edit_post(post_id):
             post.topic.last_post_id = post_id
             post.topic.group.last_post_id = post_id
             db.session.commit()
-            if post.topic.receivers:
-                for notice in post.topic.receivers:
-                    send_new_post_email(receiver=notice.receiver, topic=post.topic, user=current_user)
+            send_new_post_emails(post.topic, current_user)
             if form.notice.data and not current_user.is_noticing(post.topic):
                 current_user.notice(post.topic)
             if post.topic.author!= current_user and post.topic.author.receive_post_notification:
@@ -687,14 +716,8 @@ def upload_topic(topic_id):
         abort(403)
     if request.method == 'POST' and 'file' in request.files:
         f = request.files.get('file')
-        filename = f.filename
-        if os.path.exists(os.path.join(current_app.config['UPLOAD_PATH'], filename)):
-            filename = rename_image(filename)
-        f.save(os.path.join(current_app.config['UPLOAD_PATH'], filename))
-        filename_s = None
-        if filename.rsplit('.', 1)[1] in ['jpg', 'png', 'jpeg', 'gif', 'PNG', 'bmp']:
-            filename_s = resize_image(request.files['file'], filename, current_app.config['PHOTO_SIZE']['small'])
-        file = File(filename=filename, filename_s=filename_s, topic_id=topic_id)
+        blob = save_attachment(f)  # 按内容哈希保存，相同的文件只存一份
+        file = File(name=f.filename, filename=blob.filename, filename_s=blob.filename_s, blob=blob, topic_id=topic_id)
         db.session.add(file)
         db.session.commit()
     return render_template('main/upload_topic.html', topic=topic)
@@ -709,14 +732,8 @@ def upload_post(post_id):
         abort(403)
     if request.method == 'POST' and 'file' in request.files:
         f = request.files.get('file')
-        filename = f.filename
-        if os.path.exists(os.path.join(current_app.config['UPLOAD_PATH'], filename)):
-            filename = rename_image(filename)
-        f.save(os.path.join(current_app.config['UPLOAD_PATH'], filename))
-        filename_s = None
-        if filename.rsplit('.', 1)[1] in ['jpg', 'png', 'jpeg', 'gif', 'PNG', 'bmp']:
-            filename_s = resize_image(request.files['file'], filename, current_app.config['PHOTO_SIZE']['small'])
-        file = File(filename=filename, filename_s=filename_s, post_id=post_id)
+        blob = save_attachment(f)  # 按内容哈希保存，相同的文件只存一份
+        file = File(name=f.filename, filename=blob.filename, filename_s=blob.filename_s, blob=blob, post_id=post_id)
         db.session.add(file)
         db.session.commit()
     return render_template('main/upload_post.html', post=post)
@@ -1,33 +1,17 @@
 # coding=utf-8
-from flask import Blueprint, render_template, request, redirect, current_app, flash, url_for, send_from_directory
+from flask import Blueprint, render_template, request, redirect, current_app, flash, url_for
 from flask_login import login_required
-import os
-import PIL
-from PIL import Image
 
 from blogs.decorators import permission_required
 from blogs.models.tecon import Item, Series, Photo
 from blogs.forms.tecon import ItemForm, EditItemForm, UploadForm
 from blogs.extensions import db
-from blogs.utils import rename_image
+from blogs.utils import rename_image, send_upload, resize_image
+from blogs import storage
 
 view_bp = Blueprint('tecon', __name__)
 
 
-def resize_image(image, filename, base_width):
-    filename, ext = os.path.splitext(filename)
-    img = Image.open(image)
-    if img.size[0] <= base_width:
-        return filename + ext
-    w_percent = (base_width / float(img.size[0]))
-    h_size = int((float(img.size[1]) * float(w_percent)))
-    img = img.resize((base_width, h_size), PIL.Image.ANTIALIAS)
-
-    filename += current_app.config['PHOTO_SUFFIX'][base_width] + ext
-    img.save(os.path.join(current_app.config['TECON_PATH'], filename), optimize=True, quality=85)
-    return filename
-
-
 @view_bp.route('/')
 def index():
     newses = Item.query.filter_by(saved=False, series_id=3).order_by(Item.timestamp.desc()).limit(3)
@@ -150,7 +134,7 @@ def manage_list():
 
 @view_bp.route('/uploads/<path:filename>')
 def get_image(filename):
-    return send_from_directory(current_app.config['TECON_PATH'], filename)
+    return send_upload('TECON_PATH', filename)
 
 
 @view_bp.route('/upload/<int:item_id>', methods=['POST', 'GET'])
@@ -164,9 +148,9 @@ def upload(item_id):
             db.session.delete(item.photo)
             db.session.commit()
         f = form.photo.data
-        filename = rename_image(f.filename)
-        f.save(os.path.join(current_app.config['TECON_PATH'], filename))
-        filename_s = resize_image(f, filename, current_app.config['PHOTO_SIZE']['small'])
+        filename = rename_image(f.filename, 'TECON_PATH')
+        storage.save('TECON_PATH', filename, f)
+        filename_s = resize_image(filename, current_app.config['PHOTO_SIZE']['small'], 'TECON_PATH')
         photo = Photo(filename=filename,
                       filename_s=filename_s,
                       item_id=item_id)
@@ -1,14 +1,19 @@
 from flask import Blueprint, request, current_app, render_template, flash, redirect, url_for, abort
 from flask_login import current_user, logout_user, login_required, fresh_login_required
+from uuid import uuid4
 
 from blogs.models.blogs import User, Post, Collect, Notice, Topic, Notification
 from blogs.forms.user import EditProfileForm, CropAvatarForm, UploadAvatarForm, ChangePasswordForm, \
     NotificationSettingForm, ChangeEmailForm
-from blogs.extensions import db, avatars
+from blogs.extensions import db
 from blogs.utils import flash_errors, generate_token, validate_token, redirect_back
+from blogs.images import image_service
+from blogs import storage
+from blogs.pagination import keyset_paginate
 from blogs.decorators import confirm_required
 from blogs.settings import Operations
 from blogs.emails import send_user_confirm_email
+from blogs.events import publish_unread_count
 
 user_bp = Blueprint('user', __name__)
 
@@ -21,12 +26,13 @@ def index(username):
     if user == current_user and not user.active:
         logout_user()
 
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['TOPIC_PER_PAGE']
-    pagination = Topic.query.with_parent(user).filter_by(saved=False, deleted=False).order_by(Topic.timestamp.desc()).\
-        paginate(page, per_page)
+    pagination = keyset_paginate(Topic.query.with_parent(user).options(*Topic.list_options()).
+                                 filter_by(saved=False, deleted=False), Topic.timestamp, Topic.id, per_page)
     topics = pagination.items
-    return render_template('user/topics.html', user=user, pagination=pagination, topics=topics)
+    receiver_counts = Topic.receiver_counts([topic.id for topic in topics])
+    return render_template('user/topics.html', user=user, pagination=pagination, topics=topics,
+                           receiver_counts=receiver_counts)
 
 
 @user_bp.route('/settings/profile', methods=['GET', 'POST'])
@@ -64,7 +70,8 @@ def upload_avatar():
     form = UploadAvatarForm()
     if form.validate_on_submit():
         image = form.upload.data
-        filename = avatars.save_avatar(image)
+        filename = uuid4().hex + '_raw.png'
+        storage.save('AVATARS_SAVE_PATH', filename, image)
         current_user.avatar_raw = filename
         db.session.commit()
         flash('图片已上传，请剪切图片。', 'success')
@@ -82,7 +89,7 @@ def crop_avatar():
         y = form.y.data
         w = form.w.data
         h = form.h.data
-        filenames = avatars.crop_avatar(current_user.avatar_raw, x, y, w, h)
+        filenames = image_service.crop_avatar(current_user.avatar_raw, x, y, w, h)  # 三种尺寸在后台生成
         current_user.avatar_s = filenames[0]
         current_user.avatar_m = filenames[1]
         current_user.avatar_l = filenames[2]
@@ -113,12 +120,14 @@ def notification_setting():
         current_user.receive_collect_notification = form.receive_collect_notification.data
         current_user.receive_post_notification = form.receive_post_notification.data
         current_user.receive_notice_notification = form.receive_notice_notification.data
+        current_user.set_notice_email(form.notice_email.data)
         db.session.commit()
         flash('通知设置已更新', 'success')
         return redirect(url_for('user.index', username=current_user.username))
     form.receive_collect_notification.data = current_user.receive_collect_notification
     form.receive_post_notification.data = current_user.receive_post_notification
     form.receive_notice_notification.data = current_user.receive_notice_notification
+    form.notice_email.data = current_user.notice_email
     return render_template('user/setting/edit_notification.html', form=form)
 
 
@@ -171,10 +180,9 @@ def my_posts(username):
     user = User.query.filter_by(username=username).first()
     if user == current_user and not user.active :
         logout_user()
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['TOPIC_PER_PAGE']
-    pagination = Post.query.with_parent(user).filter_by(saved=False, deleted=False)\
-        .order_by(Post.timestamp.desc()).paginate(page, per_page)
+    pagination = keyset_paginate(Post.query.with_parent(user).filter_by(saved=False, deleted=False),
+                                 Post.timestamp, Post.id, per_page)
     posts = pagination.items
     return render_template('user/posts.html', posts=posts, pagination=pagination, user=user)
 
@@ -209,8 +217,8 @@ def delete_notification(notification_id):
     if notification.receiver != current_user:
         abort(403)
 
-    db.session.delete(notification)
-    db.session.commit()
+    current_user.delete_notification(notification)
+    publish_unread_count(current_user)
     flash('已成功删除通知。', 'success')
     return redirect_back()
 
@@ -218,9 +226,7 @@ def delete_notification(notification_id):
 @user_bp.route('/delete_all_notification', methods=['POST'])
 @login_required
 def delete_all_notification():
-    notifications = Notification.query.with_parent(current_user).all()
-    for notification in notifications:
-        db.session.delete(notification)
-    db.session.commit()
+    current_user.delete_all_notifications()
+    publish_unread_count(current_user)
     flash('已成功删除所有通知信息。', 'success')
     return redirect_back()
\ No newline at end of file
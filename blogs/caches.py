@@ -0,0 +1,246 @@
+import time
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+from hashlib import md5
+from threading import Lock
+
+from flask import current_app, g, request
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from markupsafe import Markup
+from sqlalchemy import inspect
+from sqlalchemy.orm import object_session
+
+from blogs.extensions import db
+from blogs.models.blogs import Forum, Topic, Post, User, File
+from blogs.models.tecon import Item, Photo
+
+NavItem = namedtuple('NavItem', ['id', 'name', 'photo'])
+NavPhoto = namedtuple('NavPhoto', ['filename', 'filename_s'])
+GroupInfo = namedtuple('GroupInfo', ['id', 'name', 'intro'])
+
+
+class VersionedCache(object):
+    """进程内缓存。每个命名空间有一个版本号，相关数据提交后版本号加一，旧版本的缓存随即失效。"""
+
+    def __init__(self):
+        self._versions = {}
+        self._entries = {}
+        self._lock = Lock()
+
+    def version(self, namespace):
+        return self._versions.get(namespace, 0)
+
+    def bump(self, namespace):
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+
+    def get_or_create(self, namespace, key, creator, timeout=None):
+        version = self.version(namespace)
+        entry = self._entries.get((namespace, key))
+        if entry is not None and entry[0] == version and (entry[1] is None or entry[1] > time.time()):
+            return entry[2]
+        value = creator()
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            self._entries[(namespace, key)] = (version, expires, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = VersionedCache()
+
+
+def watch(model, namespace, attrs=None):
+    """model 写入时记下 namespace，事务提交后再递增版本号；attrs 限定哪些列的更新才算变动。"""
+
+    def mark(target):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('changed_namespaces', set()).add(namespace)
+
+    @db.event.listens_for(model, 'after_insert', named=True)
+    @db.event.listens_for(model, 'after_delete', named=True)
+    def on_write(**kwargs):
+        mark(kwargs['target'])
+
+    @db.event.listens_for(model, 'after_update', named=True)
+    def on_update(**kwargs):
+        target = kwargs['target']
+        state = inspect(target)
+        if attrs is None or any(state.attrs[attr].history.has_changes() for attr in attrs):
+            mark(target)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def bump_changed_namespaces(session):
+    for namespace in session.info.pop('changed_namespaces', ()):
+        cache.bump(namespace)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_changed_namespaces(session):
+    session.info.pop('changed_namespaces', None)
+
+
+watch(Item, 'tecon_nav')
+watch(Photo, 'tecon_nav')
+watch(Forum, 'group_info', attrs=['name', 'intro'])
+for model in [Forum, Topic, Post, User, File]:
+    watch(model, 'pages')
+
+
+def _nav_item(item):
+    photo = NavPhoto(item.photo.filename, item.photo.filename_s) if item.photo else None
+    return NavItem(item.id, item.name, photo)
+
+
+def load_nav_items():
+    introduces = Item.query.options(db.joinedload(Item.photo)).filter_by(saved=False, series_id=1).\
+        order_by(Item.name).all()
+    products = Item.query.options(db.joinedload(Item.photo)).filter_by(saved=False, series_id=2).\
+        order_by(Item.name).all()
+    return [_nav_item(item) for item in introduces], [_nav_item(item) for item in products]
+
+
+def get_nav_items():
+    return cache.get_or_create('tecon_nav', 'nav_items', load_nav_items,
+                               current_app.config['CONTEXT_CACHE_TIMEOUT'])
+
+
+def get_group_info(group_id):
+    def load():
+        group = Forum.query.get(group_id)
+        return GroupInfo(group.id, group.name, group.intro) if group else None
+    return cache.get_or_create('group_info', group_id, load, current_app.config['CONTEXT_CACHE_TIMEOUT'])
+
+
+CSRF_PLACEHOLDER = '__cached_csrf_token__'
+PAGE_NAMESPACES = ('pages', 'tecon_nav', 'group_info')  # 整页内容依赖的命名空间
+
+PageEntry = namedtuple('PageEntry', ['versions', 'expires', 'etag', 'last_modified', 'body'])
+
+
+def strip_csrf(html):
+    # 缓存前把当前会话的 CSRF 令牌换成占位符，避免把一个会话的令牌发给别人
+    token = g.get(current_app.config['WTF_CSRF_FIELD_NAME'])
+    return html.replace(token, CSRF_PLACEHOLDER) if token else html
+
+
+def fill_csrf(html):
+    return html.replace(CSRF_PLACEHOLDER, generate_csrf()) if CSRF_PLACEHOLDER in html else html
+
+
+class FragmentCache(object):
+    """渲染好的 HTML 片段缓存，容量满了淘汰最久没用的。
+
+    键里带着相关对象的版本号（见 models.blogs.bump_versions），对象改动后旧片段不会再命中，只等着被淘汰。
+    """
+
+    def __init__(self, app=None, size=2000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.size = app.config['FRAGMENT_CACHE_SIZE']
+        app.jinja_env.globals['cache_fragment'] = cache_fragment
+
+    def get(self, key, valid=None):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None or (valid is not None and not valid(value)):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+fragment_cache = FragmentCache()
+
+
+def cache_fragment(name, *objects, vary=(), caller=None):
+    """在模板里用 {% call cache_fragment('post', post, post.author, vary=(...)) %}...{% endcall %} 缓存一段 HTML。
+
+    键由片段名、各对象的 (类型, id, 版本号)、访问者的权限位和 vary 组成；vary 放其余会影响输出的访问者信息，
+    比如是不是作者。片段里的 CSRF 令牌存成占位符，输出时换成当前会话的令牌。
+    """
+    if not current_app.config['FRAGMENT_CACHE_SIZE']:
+        return caller()
+    key = (name, tuple((type(obj).__name__, obj.id, obj.version) for obj in objects if obj is not None),
+           current_user.permission_mask, tuple(vary))
+    html = fragment_cache.get(key)
+    if html is None:
+        html = strip_csrf(str(caller()))
+        fragment_cache.set(key, html)
+    return Markup(fill_csrf(html))
+
+
+class PageCache(FragmentCache):
+    """游客访问的整页缓存，按 URL 保存渲染结果；页面相关数据有提交、或者超过 PAGE_CACHE_TIMEOUT 就重新渲染。
+
+    多进程部署时其他进程的写入只能靠超时失效。
+    """
+
+    def __init__(self, app=None, size=500):
+        self.timeout = 60
+        super(PageCache, self).__init__(app, size)
+
+    def init_app(self, app):
+        self.size = app.config['PAGE_CACHE_SIZE']
+        self.timeout = app.config['PAGE_CACHE_TIMEOUT']
+
+    @staticmethod
+    def versions():
+        return tuple(cache.version(namespace) for namespace in PAGE_NAMESPACES)
+
+    def lookup(self, url):
+        versions = self.versions()
+        return self.get(url, valid=lambda entry: entry.versions == versions and entry.expires > time.time())
+
+    def store(self, url, body):
+        body = strip_csrf(body)
+        entry = PageEntry(self.versions(), time.time() + self.timeout, md5(body.encode('utf-8')).hexdigest(),
+                          datetime.utcnow().replace(microsecond=0), body)
+        self.set(url, entry)
+        return entry
+
+    def private_etag(self, user, state):
+        """登录用户的 ETag，不需要渲染就能比较。
+
+        state 是页面内容依赖的持久化状态（比如各对象的 version 列），再加上导航栏的内容和用户自己的
+        version、权限、未读通知数。这些都来自数据库，不用进程内的版本号，重启或换了进程也不会把不同的内容
+        算成同一个 ETag。
+        """
+        # 页面里的 CSRF 令牌有有效期，按有效期分段，避免浏览器一直沿用带着过期令牌的页面
+        time_limit = current_app.config['WTF_CSRF_TIME_LIMIT']
+        period = int(time.time() // time_limit) if time_limit else 0
+        key = (request.full_path, state, get_nav_items(), get_group_info(3), user.id, user.version,
+               user.permission_mask, user.unread_notification_count, period)
+        return md5(repr(key).encode('utf-8')).hexdigest()
+
+
+page_cache = PageCache()
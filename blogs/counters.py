@@ -0,0 +1,126 @@
+import atexit
+import time
+from threading import Lock
+from uuid import uuid4
+
+from sqlalchemy import bindparam
+
+from blogs.extensions import db
+from blogs.models.blogs import Topic
+
+
+class MemoryStore(object):
+    """进程内的计数缓冲。多进程共享计数时可换成实现了 incr/get/drain 的外部存储。"""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = Lock()
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + amount
+
+    def get(self, key):
+        return self._counts.get(key, 0)
+
+    def drain(self):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        return counts
+
+
+class RedisStore(object):
+    """多进程共用的计数缓冲，存在 Redis 的一个 hash 里，需要安装 redis。
+
+    所有 worker 累加到同一个 hash，任何一个进程（包括 flask flush-view-counts）都能写回全部计数。
+    """
+
+    def __init__(self, url, key='forum:view-counts'):
+        self.url = url
+        self.key = key
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError('VIEW_COUNTER_STORE = "redis" requires redis.')
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def incr(self, key, amount=1):
+        self.client.hincrby(self.key, key, amount)
+
+    def get(self, key):
+        return int(self.client.hget(self.key, key) or 0)
+
+    def drain(self):
+        from redis.exceptions import ResponseError
+        # 先把 hash 改名再读，改名之后的累加进新的 hash，读和删之间不会丢
+        draining = '%s:%s' % (self.key, uuid4().hex)
+        try:
+            self.client.rename(self.key, draining)
+        except ResponseError:  # 没有待写回的计数
+            return {}
+        counts = self.client.hgetall(draining)
+        self.client.delete(draining)
+        return dict((int(key), int(amount)) for key, amount in counts.items())
+
+
+class ViewCounter(object):
+    """主题浏览数写缓冲：浏览时只在内存里累加，定期合并成一次批量 UPDATE 写回数据库。"""
+
+    def __init__(self, app=None, store=None):
+        self.store = store or MemoryStore()
+        self.interval = 30
+        self._last_flush = time.time()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.interval = app.config['VIEW_COUNTER_FLUSH_INTERVAL']
+        if app.config['VIEW_COUNTER_STORE'] == 'redis':
+            self.store = RedisStore(app.config['VIEW_COUNTER_REDIS_URL'])
+
+        @app.teardown_request
+        def flush_if_due(exception=None):
+            if time.time() - self._last_flush >= self.interval:
+                try:
+                    self.flush()
+                except Exception:
+                    app.logger.exception('Failed to flush view counts.')
+
+        def flush_on_exit():
+            with app.app_context():
+                self.flush()
+
+        atexit.register(flush_on_exit)
+
+    def incr(self, topic_id):
+        self.store.incr(topic_id)
+
+    def pending(self, topic_id):
+        return self.store.get(topic_id)
+
+    def flush(self):
+        self._last_flush = time.time()
+        counts = self.store.drain()
+        if not counts:
+            return 0
+        statement = Topic.__table__.update().where(Topic.id == bindparam('topic_id')).\
+            values(read_time=Topic.read_time + bindparam('amount'))
+        try:
+            # 用独立连接写回，不影响当前请求的 session
+            with db.engine.begin() as connection:
+                connection.execute(statement, [dict(topic_id=topic_id, amount=amount)
+                                               for topic_id, amount in counts.items()])
+        except Exception:
+            for topic_id, amount in counts.items():
+                self.store.incr(topic_id, amount)
+            raise
+        return len(counts)
+
+
+view_counter = ViewCounter()
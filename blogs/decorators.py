@@ -1,7 +1,9 @@
-from flask import abort, url_for, flash, redirect, Markup
+from flask import abort, url_for, flash, redirect, Markup, request, session, current_app, make_response
 from flask_login import current_user
 from functools import wraps
 
+from blogs.caches import page_cache, fill_csrf
+
 
 def permission_required(permission_name):
     def decorator(func):
@@ -28,4 +30,45 @@ def confirm_required(func):
             flash(message, 'warning')
             return redirect(url_for('main.index'))
         return func(*args, **kwargs)
-    return decorated_function
\ No newline at end of file
+    return decorated_function
+
+def cache_page(on_hit=None, private=None):
+    """游客的 GET 请求走整页缓存，带 ETag/Last-Modified，条件请求命中直接回 304，不查数据库。
+
+    on_hit 在缓存命中时用视图参数调用，用来补上被跳过的副作用（比如浏览计数）。
+    private 是一个函数，用视图参数调用，返回页面内容依赖的持久化状态（比如各对象的 version 列）；给了它，
+    登录用户也按这些状态算 ETag（见 PageCache.private_etag），没变就回 304。只适合内容只和角色有关的页面。
+    """
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            if request.method != 'GET' or '_flashes' in session or not current_app.config['PAGE_CACHE_SIZE']:
+                return func(*args, **kwargs)
+            if current_user.is_authenticated:
+                if private is None:
+                    return func(*args, **kwargs)
+                etag = page_cache.private_etag(current_user, private(*args, **kwargs))
+                if etag in request.if_none_match:
+                    response = make_response('', 304)
+                else:
+                    response = make_response(func(*args, **kwargs))
+                response.set_etag(etag)
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+                return response
+
+            entry = page_cache.lookup(request.full_path)
+            if entry is None:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200 or response.mimetype != 'text/html':
+                    return response
+                entry = page_cache.store(request.full_path, response.get_data(as_text=True))
+            elif on_hit is not None:
+                on_hit(*args, **kwargs)
+            response = make_response(fill_csrf(entry.body))
+            response.set_etag(entry.etag)
+            response.last_modified = entry.last_modified
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+        return decorated_function
+    return decorator
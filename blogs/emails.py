@@ -1,24 +1,197 @@
-from threading import Thread
+import atexit
+import os
+import smtplib
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
 
 from flask import current_app, render_template
 from flask_mail import Message
 
-from blogs.extensions import mail
+from blogs.extensions import mail, db
+from blogs.models.blogs import User, Notice, Topic, Post
 
 
-def _send_async_mail(app, message):
-    with app.app_context():
-        mail.send(message)
+class MailQueue(object):
+    """发信队列：几个后台线程各自保持一条 SMTP 连接，每次从队列里取出一批邮件连续发送。
 
+    连接出错时断开重连，按指数退避重试；队列满了 send() 最多等 MAIL_QUEUE_TIMEOUT 秒，仍然放不下就丢弃并记日志。
+    MAIL_WORKERS 为 0 时在调用的线程里直接发送。stats() 返回队列长度和发送统计。
+    """
 
-def send_mail(to, subject, template, **kwargs):
+    def __init__(self, app=None):
+        self.app = None
+        self.workers = 2
+        self.batch_size = 50
+        self.retries = 3
+        self.backoff = 1.0
+        self.put_timeout = 5.0
+        self.idle_timeout = 30.0
+        self._queue = Queue()
+        self._threads = []
+        self._pid = None
+        self._lock = Lock()
+        self.sent = self.failed = self.retried = self.dropped = self.connections = self.batches = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config['MAIL_WORKERS']
+        self.batch_size = app.config['MAIL_BATCH_SIZE']
+        self.retries = app.config['MAIL_RETRIES']
+        self.backoff = app.config['MAIL_RETRY_BACKOFF']
+        self.put_timeout = app.config['MAIL_QUEUE_TIMEOUT']
+        self.idle_timeout = app.config['MAIL_IDLE_TIMEOUT']
+        self._queue = Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        atexit.register(self.shutdown)
+
+    def _start(self):
+        # 线程不能跨 fork 使用，每个 worker 进程第一次发信时自己启动
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = Queue(maxsize=self._queue.maxsize)
+                self._threads = [Thread(target=self._run, name='mail-%d' % i, daemon=True)
+                                 for i in range(self.workers)]
+                for thread in self._threads:
+                    thread.start()
+                self._pid = os.getpid()
+
+    def shutdown(self, timeout=10):
+        """把队列里剩下的邮件发完再退出。"""
+        if self._pid != os.getpid():
+            return
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._pid = None
+
+    def send(self, message):
+        if not self.workers:
+            self._close(self._deliver(None, message)[0])
+            return
+        self._start()
+        try:
+            self._queue.put(message, timeout=self.put_timeout)
+        except Full:
+            self._count('dropped')
+            self.app.logger.error('Mail queue is full, dropped message to %s.', ', '.join(message.send_to))
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def _run(self):
+        with self.app.app_context():
+            connection = None
+            stopping = False
+            while not stopping:
+                try:
+                    message = self._queue.get(timeout=self.idle_timeout)
+                except Empty:
+                    connection = self._close(connection)  # 空闲连接迟早被服务器断开，先主动关掉
+                    continue
+                batch = []
+                while message is not None:
+                    batch.append(message)
+                    if len(batch) >= self.batch_size:
+                        break
+                    try:
+                        message = self._queue.get_nowait()
+                    except Empty:
+                        break
+                stopping = message is None
+                if batch:
+                    self._count('batches')
+                for message in batch:
+                    connection, _ = self._deliver(connection, message)
+            self._close(connection)
+
+    def _deliver(self, connection, message):
+        """发送一封邮件，返回 (之后可以接着用的连接, 是否发出去了)，连接可能是新建的，也可能是 None。"""
+        for attempt in range(self.retries + 1):
+            try:
+                if connection is None:
+                    connection = mail.connect().__enter__()
+                    self._count('connections')
+                connection.send(message)
+                self._count('sent')
+                return connection, True
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused) as e:
+                # 地址被拒绝，重试也没用；连接本身还能继续用
+                self._count('failed')
+                self.app.logger.error('Mail to %s refused: %r', ', '.join(message.send_to), e)
+                return connection, False
+            except (smtplib.SMTPException, OSError) as e:
+                connection = self._close(connection)
+                if attempt == self.retries:
+                    self._count('failed')
+                    self.app.logger.error('Failed to send mail to %s: %r', ', '.join(message.send_to), e)
+                    return None, False
+                self._count('retried')
+                time.sleep(self.backoff * 2 ** attempt)
+            except Exception:
+                # 邮件本身有问题（比如 BadHeaderError），只算这一封失败，不能让异常结束发信线程；
+                # 不确定连接处在什么状态，断开重连
+                self._count('failed')
+                self.app.logger.exception('Failed to send mail to %s.', ', '.join(message.send_to))
+                return self._close(connection), False
+
+    @contextmanager
+    def direct(self):
+        """不经过队列，在当前线程里用一条连接逐封发送：with mail_queue.direct() as send: ok = send(message)。
+
+        send 返回这封邮件是否发出去了；命令行任务要按发送结果更新状态时用，不会因为队列满或者进程退出丢信。
+        """
+        state = dict(connection=None)
+
+        def send(message):
+            state['connection'], delivered = self._deliver(state['connection'], message)
+            return delivered
+        try:
+            yield send
+        finally:
+            self._close(state['connection'])
+
+    @staticmethod
+    def _close(connection):
+        if connection is not None and connection.host is not None:
+            try:
+                connection.host.quit()
+            except Exception:
+                connection.host.close()
+        return None
+
+    def stats(self):
+        with self._lock:
+            return dict(workers=self.workers,
+                        queue_depth=self._queue.qsize(),
+                        sent=self.sent,
+                        failed=self.failed,
+                        retried=self.retried,
+                        dropped=self.dropped,
+                        connections=self.connections,
+                        batches=self.batches,
+                        avg_batch_size=float(self.sent + self.failed) / (self.batches or 1))
+
+
+mail_queue = MailQueue()
+
+
+def make_mail(to, subject, template, **kwargs):
     message = Message(current_app.config['MAIL_SUBJECT_PREFIX'] + subject, recipients=[to])
     message.body = render_template(template + '.txt', **kwargs)
     message.html = render_template(template + '.html', **kwargs)
-    app = current_app._get_current_object()
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    thr.start()
-    return thr
+    return message
+
+
+def send_mail(to, subject, template, **kwargs):
+    mail_queue.send(make_mail(to, subject, template, **kwargs))  # 模板在请求里渲染，发送交给发信线程
 
 
 def send_notice_email(user, to=None):
@@ -39,5 +212,57 @@ def send_new_post_email(receiver, topic, user):
               receiver=receiver)
 
 
+def send_new_post_emails(topic, user):
+    # 只发给选择逐条发送的订阅者，选择汇总的由 send_digest_emails 定时发送
+    receivers = User.query.join(Notice, Notice.receiver_id == User.id).\
+        filter(Notice.noticed_id == topic.id, User.notice_email == 'instant', User.id != user.id)
+    for receiver in receivers:
+        send_new_post_email(receiver=receiver, topic=topic, user=user)
+
+
+def digest_mail(receiver, topics):
+    return make_mail(subject='您关注的帖子有新回复', to=receiver.email, template='emails/digest', receiver=receiver,
+                     topics=topics)
+
+
+def _pending_posts():
+    # 订阅之后（或上一封汇总之后）别人发表的回帖
+    return db.session.query(Notice, Post).\
+        join(Post, Post.topic_id == Notice.noticed_id).\
+        join(Topic, Topic.id == Notice.noticed_id).\
+        join(User, User.id == Notice.receiver_id).\
+        filter(User.notice_email == 'digest', Topic.deleted == False, Post.saved == False, Post.deleted == False,
+               Post.author_id != Notice.receiver_id,
+               Post.timestamp > db.func.coalesce(Notice.last_emailed, Notice.timestamp))
+
+
+def send_digest_emails(window, batch_size=100):
+    """给选择汇总的订阅者发送新回帖汇总邮件，返回发出的邮件数。
+
+    某个用户最早一条没发过的回帖超过 window 秒才发，这段时间里所有订阅帖子的回帖合并成一封。
+    每批用户的内容由一次 Notice 和 Post 的联合查询取出，发完一批提交一次。
+    邮件在当前线程里直接发送，只有发出去的才推进 Notice.last_emailed，没发出去的下次运行再发。
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=window)
+    due = [receiver_id for receiver_id, in _pending_posts().with_entities(Notice.receiver_id).
+           group_by(Notice.receiver_id).having(db.func.min(Post.timestamp) <= cutoff)]
+    sent = 0
+    with mail_queue.direct() as send:
+        for start in range(0, len(due), batch_size):
+            digests = OrderedDict()
+            rows = _pending_posts().filter(Notice.receiver_id.in_(due[start:start + batch_size])).\
+                options(db.joinedload(Post.author)).order_by(Notice.receiver_id, Notice.noticed_id, Post.timestamp)
+            for notice, post in rows:
+                digests.setdefault(notice.receiver, OrderedDict()).setdefault(notice, []).append(post)
+            for receiver, notices in digests.items():
+                if not send(digest_mail(receiver, [(notice.noticed, posts) for notice, posts in notices.items()])):
+                    continue
+                for notice, posts in notices.items():
+                    notice.last_emailed = posts[-1].timestamp
+                sent += 1
+            db.session.commit()
+    return sent
+
+
 def send_user_confirm_email(user, token, to=None):
     send_mail(subject='邮箱确认', to=to or user.email, template='emails/user_confirm', user=user, token=token)
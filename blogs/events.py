@@ -0,0 +1,169 @@
+import os
+import time
+from threading import Event, Lock, Thread
+
+
+class LocalBackend(object):
+    """只在本进程内广播，单进程部署或开发时用。多进程时其他进程的连接收不到，页面靠轮询补上。"""
+
+    shared = False  # 是否跨进程广播
+
+    def __init__(self, config=None):
+        self._callback = None
+
+    def start(self, callback, logger):
+        self._callback = callback
+
+    def publish(self, user_id, count):
+        if self._callback is not None:
+            self._callback(user_id, count)
+
+
+class RedisBackend(object):
+    """经 Redis 发布/订阅广播给所有进程，需要安装 redis。每个进程只用一个线程接收消息。"""
+
+    shared = True
+
+    def __init__(self, config):
+        self.url = config['NOTIFY_REDIS_URL']
+        self.channel = config['NOTIFY_REDIS_CHANNEL']
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError('NOTIFY_BACKEND = "redis" requires redis.')
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def start(self, callback, logger):
+        thread = Thread(target=self._listen, args=(callback, logger), name='notify-listener', daemon=True)
+        thread.start()
+
+    def _listen(self, callback, logger):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    user_id, count = message['data'].split(b':')
+                    callback(int(user_id), int(count))
+            except Exception:
+                logger.exception('Notification listener disconnected, reconnecting.')
+                time.sleep(1)
+
+    def publish(self, user_id, count):
+        self.client.publish(self.channel, '%d:%d' % (user_id, count))
+
+
+BACKENDS = {'local': LocalBackend, 'redis': RedisBackend}
+
+
+class Subscription(object):
+    """一条 SSE 连接。只保留最新的未读数，客户端来不及读时旧的数直接被覆盖。"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.count = None
+        self._event = Event()
+
+    def put(self, count):
+        self.count = count
+        self._event.set()
+
+    def get(self, timeout):
+        """等到有新的数或者超时，超时返回 None。"""
+        if not self._event.wait(timeout):
+            return None
+        self._event.clear()
+        return self.count
+
+
+class NotificationHub(object):
+    """未读通知数的发布/订阅中心：通知数变化时 publish，SSE 连接 subscribe 后只在变化时收到新的数。
+
+    连接只是登记在字典里的 Subscription，等待时不占用 hub 的线程；用 gevent 等协程 worker 部署时一个进程
+    可以挂住成千上万条空闲连接。跨进程广播由 NOTIFY_BACKEND 选择的后端完成。
+    """
+
+    def __init__(self, app=None):
+        self.backend = LocalBackend()
+        self.heartbeat = 25
+        self.max_age = 600
+        self.retry = 5
+        self.logger = None
+        self._subscribers = {}
+        self._lock = Lock()
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = BACKENDS[app.config['NOTIFY_BACKEND']](app.config)
+        self.heartbeat = app.config['NOTIFY_STREAM_HEARTBEAT']
+        self.max_age = app.config['NOTIFY_STREAM_MAX_AGE']
+        self.retry = app.config['NOTIFY_STREAM_RETRY']
+        self.logger = app.logger
+        app.jinja_env.globals['notification_hub'] = self
+
+    def _listen(self):
+        # 接收线程不能跨 fork 使用，每个 worker 进程第一次有连接时自己启动
+        with self._lock:
+            if self._pid != os.getpid():
+                self.backend.start(self._dispatch, self.logger)
+                self._pid = os.getpid()
+
+    def subscribe(self, user_id):
+        self._listen()
+        subscription = Subscription(user_id)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[subscription.user_id]
+
+    def publish(self, user_id, count):
+        try:
+            self.backend.publish(user_id, count)
+        except Exception:
+            # 推送失败不影响当前请求，客户端重连时会拿到最新的数
+            self.logger.exception('Failed to publish notification count.')
+
+    def _dispatch(self, user_id, count):
+        with self._lock:
+            subscriptions = list(self._subscribers.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.put(count)
+
+    def stream(self, subscription, count):
+        """生成 SSE 消息：先发当前的数，之后只在变化时发，空闲时定期发注释保活。
+
+        连接超过 max_age 秒后结束，浏览器会在 retry 秒后自动重连。
+        """
+        yield 'retry: %d\ndata: %d\n\n' % (self.retry * 1000, count)
+        deadline = time.time() + self.max_age
+        while time.time() < deadline:
+            count = subscription.get(min(self.heartbeat, deadline - time.time()))
+            yield ': keepalive\n\n' if count is None else 'data: %d\n\n' % count
+
+    def stats(self):
+        with self._lock:
+            return dict(backend=type(self.backend).__name__, users=len(self._subscribers),
+                        connections=sum(len(subscriptions) for subscriptions in self._subscribers.values()))
+
+
+notification_hub = NotificationHub()
+
+
+def publish_unread_count(user):
+    """提交之后调用，把 user 最新的未读通知数推给他打开的页面。"""
+    notification_hub.publish(user.id, user.unread_notification_count)
@@ -32,6 +32,8 @@ login_manager.needs_refresh_message = '为了保护你的账户安全，请重
 
 
 class Guest(AnonymousUserMixin):
+    permission_mask = 0  # 游客没有任何权限位
+
     @property
     def is_admin(self):
         return False
@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import SubmitField, StringField, HiddenField, PasswordField, BooleanField
+from wtforms import SubmitField, StringField, HiddenField, PasswordField, BooleanField, SelectField
 from wtforms.validators import Length, DataRequired, Regexp, EqualTo, ValidationError, Optional, Email
 from flask_wtf.file import FileField, FileAllowed, FileRequired
 from flask_login import current_user
@@ -47,6 +47,9 @@ class NotificationSettingForm(FlaskForm):
     receive_post_notification = BooleanField('新回帖通知')
     receive_collect_notification = BooleanField('新收藏者通知')
     receive_notice_notification = BooleanField('新订阅者通知')
+    notice_email = SelectField('订阅帖子有新回帖时', choices=[('instant', '每条回帖发一封邮件'),
+                                                      ('digest', '定时汇总成一封邮件'),
+                                                      ('off', '不发邮件')])
     submit = SubmitField('保存')
 
 
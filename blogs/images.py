@@ -0,0 +1,287 @@
+import atexit
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from threading import Lock
+from uuid import uuid4
+
+from flask import current_app
+from PIL import Image
+from werkzeug.urls import url_unquote
+
+from blogs import storage
+
+VARIANT_FORMATS = ('jpg', 'jpeg', 'png')  # 生成多种宽度和 WebP 版本的图片格式，GIF 可能是动图，不处理
+IMG_TAG = re.compile(r'<img\b[^>]*>', re.I)
+UPLOAD_SRC = re.compile(r'\ssrc=(["\'])([^"\']*/uploads/([^"\'/?#]+))\1', re.I)
+
+
+def _open(path, width):
+    img = Image.open(path)
+    # JPEG 直接按接近目标的尺寸解码，手机拍的大图不用完整解码
+    img.draft(img.mode, (width, max(1, img.size[1] * width // img.size[0])))
+    return img
+
+
+def _scale(img, base_width):
+    w_percent = base_width / float(img.size[0])
+    h_size = int(float(img.size[1]) * w_percent)
+    return img.resize((base_width, h_size), Image.LANCZOS)
+
+
+def _save(img, backend, path_key, filename):
+    # 先写临时文件再交给存储后端，别的进程要么看不到文件，要么看到完整的文件
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix=os.path.splitext(filename)[1],
+                                     dir=backend.temp_dir(path_key))
+    os.close(fd)
+    try:
+        img.save(temp_path, optimize=True, quality=85)
+        backend.save_file(path_key, filename, temp_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def variant_name(filename, width=None, ext=None):
+    """同一张图片的其他版本：variant_name('a.jpg', 320) 是 a_w320.jpg，variant_name('a.jpg', ext='.webp') 是 a.webp。"""
+    name, original_ext = os.path.splitext(filename)
+    return name + ('_w%d' % width if width else '') + (ext or original_ext)
+
+
+def _webp(img):
+    if img.mode in ('RGB', 'RGBA'):
+        return img
+    return img.convert('RGBA' if img.mode in ('LA', 'PA') or 'transparency' in img.info else 'RGB')
+
+
+def _finish(backend, path_key, filenames):
+    for filename in filenames:
+        backend.clear_pending(path_key, filename)
+
+
+def resize_job(backend, path_key, source, target, base_width):
+    start = time.time()
+    try:
+        with backend.local_copy(path_key, source) as path:
+            img = _scale(_open(path, base_width), base_width)
+        _save(img, backend, path_key, target)
+    finally:
+        _finish(backend, path_key, [target])
+    return time.time() - start
+
+
+def crop_avatar_job(backend, path_key, source, box, crop_base_width, sizes, targets):
+    start = time.time()
+    try:
+        with backend.local_copy(path_key, source) as path:
+            img = _open(path, crop_base_width)
+            if img.size[0] >= crop_base_width:
+                img = _scale(img, crop_base_width)
+            cropped = img.crop(box)
+        for size, target in zip(sizes, targets):
+            _save(_scale(cropped, size), backend, path_key, target)
+    finally:
+        _finish(backend, path_key, targets)
+    return time.time() - start
+
+
+def variants_job(backend, path_key, source, max_width, widths, targets):
+    start = time.time()
+    try:
+        with backend.local_copy(path_key, source) as path:
+            img = _open(path, max_width)
+            img.load()
+        master = source
+        if img.size[0] > max_width:
+            # 原图已经按 immutable 发出去了，不能改写，缩小的版本另存为 max_width 宽的变体
+            img = _scale(img, max_width)
+            master = variant_name(source, max_width)
+            _save(img, backend, path_key, master)
+        _save(_webp(img), backend, path_key, variant_name(master, ext='.webp'))
+        for width in widths:
+            variant = _scale(img, width)
+            _save(variant, backend, path_key, variant_name(source, width))
+            _save(_webp(variant), backend, path_key, variant_name(source, width, '.webp'))
+    finally:
+        _finish(backend, path_key, targets)
+    return time.time() - start
+
+
+class ImageService(object):
+    """图片处理服务：原图在请求里保存，缩放、裁剪交给进程池在后台完成。
+
+    IMAGE_WORKERS 为 0 时在当前进程里同步处理。stats() 返回排队数和耗时统计。
+    """
+
+    def __init__(self, app=None):
+        self.workers = 2
+        self.logger = None
+        self._executor = None
+        self._pid = None
+        self._lock = Lock()
+        self.submitted = self.completed = self.failed = 0
+        self.total_seconds = self.max_seconds = self.total_wait_seconds = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.workers = app.config['IMAGE_WORKERS']
+        self.logger = app.logger
+        atexit.register(self.shutdown)
+
+    def _get_executor(self):
+        # 进程池不能跨 fork 使用，每个 worker 进程第一次用到时自己创建
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def submit(self, job, path_key, targets, *args):
+        """在后台执行 job(backend, path_key, *args)；targets 是 job 会生成的文件，生成完之前标记为处理中。"""
+        backend = storage.get_backend()
+        for target in targets:
+            backend.mark_pending(path_key, target)
+        args = (backend, path_key) + args
+        with self._lock:
+            self.submitted += 1
+        submitted_at = time.time()
+        if not self.workers:
+            try:
+                seconds = job(*args)
+            except Exception:
+                self._record(submitted_at, None)
+                raise
+            self._record(submitted_at, seconds)
+            return
+        future = self._get_executor().submit(job, *args)
+        future.add_done_callback(partial(self._done, submitted_at))
+
+    def _done(self, submitted_at, future):
+        error = future.exception()
+        if error is not None:
+            self.logger.error('Image job failed: %r', error)
+            self._record(submitted_at, None)
+        else:
+            self._record(submitted_at, future.result())
+
+    def _record(self, submitted_at, seconds):
+        with self._lock:
+            if seconds is None:
+                self.failed += 1
+                return
+            self.completed += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            self.total_wait_seconds += max(0.0, time.time() - submitted_at - seconds)
+
+    def stats(self):
+        with self._lock:
+            done = self.completed or 1
+            return dict(workers=self.workers,
+                        queue_depth=self.submitted - self.completed - self.failed,
+                        submitted=self.submitted,
+                        completed=self.completed,
+                        failed=self.failed,
+                        avg_seconds=self.total_seconds / done,
+                        max_seconds=self.max_seconds,
+                        avg_wait_seconds=self.total_wait_seconds / done)
+
+    def resize(self, path_key, filename, base_width):
+        """按 base_width 生成缩略图，返回缩略图文件名；原图不比 base_width 宽时直接返回原文件名。"""
+        with storage.open_file(path_key, filename) as f, Image.open(f) as img:  # 只读文件头拿尺寸
+            width = img.size[0]
+        if width <= base_width:
+            return filename
+        name, ext = os.path.splitext(filename)
+        thumbnail = name + current_app.config['PHOTO_SUFFIX'][base_width] + ext
+        if thumbnail == filename:  # 原图可能已经被浏览器缓存，缩略图只能另存
+            raise ValueError('PHOTO_SUFFIX[%d] must not be empty.' % base_width)
+        self.submit(resize_job, path_key, [thumbnail], filename, thumbnail, base_width)
+        return thumbnail
+
+    def variants(self, path_key, filename, max_width, widths):
+        """正文图片：宽于 max_width 的另存一份 max_width 宽的版本，再生成比它窄的各个宽度，每种都另存一份 WebP。
+
+        原图不改动。返回生成的宽度列表。
+        """
+        with storage.open_file(path_key, filename) as f, Image.open(f) as img:
+            width = img.size[0]
+        widths = [w for w in sorted(widths) if w < min(width, max_width)]
+        master = variant_name(filename, max_width) if width > max_width else filename
+        targets = [variant_name(master, ext='.webp')] + ([master] if master != filename else [])
+        for w in widths:
+            targets += [variant_name(filename, w), variant_name(filename, w, '.webp')]
+        self.submit(variants_job, path_key, targets, filename, max_width, widths, targets)
+        return widths
+
+    def crop_avatar(self, filename, x, y, w, h):
+        """裁剪头像并生成三种尺寸，返回 [filename_s, filename_m, filename_l]。"""
+        name = uuid4().hex
+        filenames = [name + '_s.png', name + '_m.png', name + '_l.png']
+        box = (int(x), int(y), int(x) + int(w), int(y) + int(h))
+        self.submit(crop_avatar_job, 'AVATARS_SAVE_PATH', filenames, filename, box,
+                    current_app.config['AVATARS_CROP_BASE_WIDTH'], current_app.config['AVATARS_SIZE_TUPLE'], filenames)
+        return filenames
+
+
+image_service = ImageService()
+
+
+def _available(filename):
+    return storage.exists('UPLOAD_PATH', filename) or storage.is_pending('UPLOAD_PATH', filename)
+
+
+def _srcset(url, filename):
+    if os.path.splitext(filename)[1][1:].lower() not in VARIANT_FORMATS:
+        return None
+    try:
+        with storage.open_file('UPLOAD_PATH', filename) as f, Image.open(f) as img:
+            width = img.size[0]
+    except OSError:  # 文件不存在或者不是图片
+        return None
+    # 比 PHOTO_SIZE['medium'] 宽的原图只作为不支持 srcset 时的 src，srcset 里最宽的是另存的缩小版本
+    medium = current_app.config['PHOTO_SIZE']['medium']
+    largest = (width, filename)
+    if width > medium and _available(variant_name(filename, medium)):
+        largest = (medium, variant_name(filename, medium))
+    width = largest[0]
+    candidates = [(w, variant_name(filename, w)) for w in sorted(current_app.config['IMAGE_VARIANT_WIDTHS'])
+                  if w < width and _available(variant_name(filename, w))]
+    if not candidates and largest[1] == filename:
+        return None
+    prefix = url[:url.rindex('/') + 1]
+    srcset = ', '.join('%s%s %dw' % (prefix, name, w) for w, name in candidates + [largest])
+    return srcset, '(max-width: %dpx) 100vw, %dpx' % (width, width)
+
+
+def _rewrite_img(match):
+    tag = match.group(0)
+    attrs = ''
+    if not re.search(r'\sloading=', tag, re.I):
+        attrs += ' loading="lazy"'
+    src = UPLOAD_SRC.search(tag)
+    if src and not re.search(r'\ssrcset=', tag, re.I) and '/tecon/uploads/' not in src.group(2):
+        srcset = _srcset(src.group(2), url_unquote(src.group(3)))
+        if srcset:
+            attrs += ' srcset="%s" sizes="%s"' % srcset
+    if not attrs:
+        return tag
+    head = tag[:-2] if tag.endswith('/>') else tag[:-1]
+    tail = tag[len(head):]
+    return head.rstrip() + attrs + (' ' + tail if tail == '/>' else tail)
+
+
+def responsive_images(html):
+    """给正文里的图片加上 loading="lazy"，上传的图片有多种宽度时再加上 srcset/sizes，保存正文时调用。"""
+    if not html or '<img' not in html.lower():
+        return html
+    return IMG_TAG.sub(_rewrite_img, html)
@@ -1,7 +1,7 @@
 
 from blogs.extensions import db
-from datetime import datetime
-import os
+from datetime import datetime, timedelta
+import re
 import uuid
 from flask import current_app
 from flask_avatars import Identicon
@@ -9,6 +9,8 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 
 from blogs.extensions import whooshee
+from blogs import storage
+from blogs.images import responsive_images
 
 
 # relationship table
@@ -31,6 +33,9 @@ class Role(db.Model):
     users = db.relationship('User', back_populates='role')
     permissions = db.relationship('Permission', secondary=roles_permissions, back_populates='roles')
 
+    _permission_bits = None     # permission name -> bit, 每个进程编译一次
+    _permission_masks = None    # role id -> 权限位掩码
+
     @staticmethod
     def init_role():
         roles_permissions_map = {
@@ -55,6 +60,44 @@ class Role(db.Model):
                     db.session.add(permission)
                 role.permissions.append(permission)
         db.session.commit()
+        Role.build_permission_masks()
+
+    @staticmethod
+    def build_permission_masks():
+        bits = {}
+        id_bits = {}
+        for index, (permission_id, name) in enumerate(
+                db.session.query(Permission.id, Permission.name).order_by(Permission.id)):
+            bits[name] = id_bits[permission_id] = 1 << index
+        masks = {}
+        for role_id, permission_id in db.session.query(roles_permissions.c.role_id,
+                                                       roles_permissions.c.permission_id):
+            masks[role_id] = masks.get(role_id, 0) | id_bits[permission_id]
+        Role._permission_bits = bits
+        Role._permission_masks = masks
+
+    @staticmethod
+    def reset_permission_masks():
+        Role._permission_bits = None
+        Role._permission_masks = None
+
+    @staticmethod
+    def get_permission_mask(role_id):
+        if Role._permission_masks is None:
+            Role.build_permission_masks()
+        return Role._permission_masks.get(role_id, 0)
+
+    @staticmethod
+    def get_permission_bit(permission_name):
+        if Role._permission_bits is None:
+            Role.build_permission_masks()
+        return Role._permission_bits.get(permission_name, 0)
+
+
+@db.event.listens_for(Role.permissions, 'append', named=True)
+@db.event.listens_for(Role.permissions, 'remove', named=True)
+def reset_permission_masks(**kwargs):
+    Role.reset_permission_masks()  # 角色权限有变动，下次调用can()时重新编译
 
 
 class Status(db.Model):
@@ -88,6 +131,14 @@ class Forum(db.Model):
     last_topic_id = db.Column(db.Integer, db.ForeignKey('topic.id'))
     post_count = db.Column(db.Integer, default=0)
     topic_count = db.Column(db.Integer, default=0)
+    # 最后动态（最新主题和最新回帖中较新的一个）的冗余副本，论坛首页直接读取，不再关联查询
+    last_activity_kind = db.Column(db.String(10))  # 'topic' 或 'post'
+    last_activity_id = db.Column(db.Integer)
+    last_activity_title = db.Column(db.String(60))
+    last_activity_author_id = db.Column(db.Integer)
+    last_activity_author = db.Column(db.String(30))
+    last_activity_timestamp = db.Column(db.DateTime)
+    version = db.Column(db.Integer, default=0, server_default='0')  # 页面片段缓存的版本号
 
     topics = db.relationship('Topic', backref='group', cascade='all', lazy='dynamic',
                              primaryjoin="Topic.group_id == Forum.id", post_update=True)
@@ -95,20 +146,18 @@ class Forum(db.Model):
     status = db.relationship('Status', back_populates='groups')
     last_post = db.relationship('Post', uselist=False)
     last_topic = db.relationship('Topic', uselist=False, foreign_keys=[last_topic_id], backref='last_topic')
+    read_marks = db.relationship('GroupReadMark', back_populates='group', cascade='all')
 
     def __init__(self, **kwargs):
         super(Forum, self).__init__(**kwargs)
 
+    def _publish_posts_query(self):
+        # 通过join在数据库里按组筛选回帖，不再把组内所有主题载入内存拼IN列表
+        return Post.query.join(Topic, Post.topic_id == Topic.id).\
+            filter(Topic.group_id == self.id, Post.saved == False, Post.deleted == False)
+
     def get_last_post(self):
-        topic_id_list = []
-        for topic in self.topics:
-            topic_id_list.append(topic.id)
-        try:
-            last_post = Post.query.filter(Post.topic_id.in_(topic_id_list), Post.saved == False, Post.deleted==False). \
-                order_by(Post.timestamp.desc()).first()
-        except:
-            last_post = None
-        return last_post
+        return self._publish_posts_query().order_by(Post.timestamp.desc()).first()
 
     def get_last_post_id(self):
         try:
@@ -117,10 +166,6 @@ class Forum(db.Model):
             last_post_id = None
         return last_post_id
 
-    def last_post_sign(self):
-        sign = self.last_post.timestamp.strftime(format("%y%m%d%H%M%S"))
-        return sign
-
     def get_last_topic(self):
         if self.topics:
             last_topic = Topic.query.with_parent(self).filter_by(saved=False, deleted=False).order_by(
@@ -134,23 +179,15 @@ class Forum(db.Model):
             last_topic_id = None
         return last_topic_id
 
-    def last_topic_sign(self):
-        sign = self.last_topic.timestamp.strftime(format("%y%m%d%H%M%S"))
-        return sign
-
     def get_topic_count(self):
         topic_count = Topic.query.with_parent(self).filter_by(saved=False, deleted= False).count()
         return topic_count
 
     def get_post_count(self):
-        topic_id_list = []
-        for topic in self.topics:
-            topic_id_list.append(topic.id)
-        count = Post.query.filter(Post.topic_id.in_(topic_id_list), Post.saved == False, Post.deleted==False).count()
-        return count
+        return self._publish_posts_query().with_entities(db.func.count(Post.id)).scalar()
 
-    def top_topic(self):
-        topics = Topic.query.with_parent(self).filter_by(saved=False, top=True, deleted=False).\
+    def top_topic(self, *options):
+        topics = Topic.query.with_parent(self).options(*options).filter_by(saved=False, top=True, deleted=False).\
             order_by(Topic.top_timestamp.desc()).all()
         return topics
 
@@ -159,6 +196,55 @@ class Forum(db.Model):
         topics = Topic.query.with_parent(self).filter_by(saved=False, deleted=False).all()
         return topics
 
+    def refresh_last_activity(self):
+        topic = Topic.query.get(self.last_topic_id) if self.last_topic_id else None
+        post = Post.query.get(self.last_post_id) if self.last_post_id else None
+        if post is not None and (topic is None or post.timestamp > topic.timestamp):
+            kind, item, title = 'post', post, post.title
+        elif topic is not None:
+            kind, item, title = 'topic', topic, topic.name
+        else:
+            kind = item = title = None
+        self.last_activity_kind = kind
+        self.last_activity_id = item.id if item else None
+        self.last_activity_title = title
+        self.last_activity_author_id = item.author_id if item else None
+        self.last_activity_author = item.author.username if item else None
+        self.last_activity_timestamp = item.timestamp if item else None
+
+
+def _has_changes(target, *attrs):
+    state = db.inspect(target)
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def sync_last_activity(session, flush_context, instances):
+    # 各处写入代码只维护 last_topic/last_post，最后动态的冗余字段统一在这里跟着刷新
+    forums = set()
+    for target in list(session.new) + list(session.dirty):
+        if isinstance(target, Forum):
+            for relation, column in [('last_topic', 'last_topic_id'), ('last_post', 'last_post_id')]:
+                if _has_changes(target, relation) and not _has_changes(target, column):
+                    related = getattr(target, relation)
+                    setattr(target, column, related.id if related is not None else None)
+                if _has_changes(target, column):
+                    forums.add(target)
+        elif isinstance(target, Topic) and _has_changes(target, 'name'):
+            if target.group is not None and target.group.last_activity_kind == 'topic' and \
+                    target.group.last_activity_id == target.id:
+                forums.add(target.group)
+        elif isinstance(target, Post) and _has_changes(target, 'title'):
+            group = target.topic.group if target.topic is not None else None
+            if group is not None and group.last_activity_kind == 'post' and group.last_activity_id == target.id:
+                forums.add(group)
+        elif isinstance(target, User) and _has_changes(target, 'username') and target.id is not None:
+            session.query(Forum).filter_by(last_activity_author_id=target.id).\
+                update({'last_activity_author': target.username, 'version': Forum.version + 1},
+                       synchronize_session=False)
+    for forum in forums:
+        forum.refresh_last_activity()
+
 
 # relationship object
 class Collect(db.Model):
@@ -170,7 +256,7 @@ class Collect(db.Model):
     collected = db.relationship('Topic', back_populates='collectors', lazy='joined')
 
 
-#relationship object
+#relationship object，旧的已读记录表，只保留给 convert-views 命令迁移数据用
 class View(db.Model):
     reader_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     readed_id = db.Column(db.Integer, db.ForeignKey('topic.id'), primary_key=True)
@@ -179,11 +265,92 @@ class View(db.Model):
     readed = db.relationship('Topic', back_populates='readers', lazy='joined')
 
 
+#relationship object，用户在某个组的已读水位：last_activity 不晚于这个时间的主题都算已读，读主题时自动往前推
+class GroupReadMark(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    group_id = db.Column(db.Integer, db.ForeignKey('forum.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    user = db.relationship('User', back_populates='group_read_marks')
+    group = db.relationship('Forum', back_populates='read_marks')
+
+
+#relationship object，例外：组水位之上已经读过的主题，组水位越过它之后删除
+class ReadMark(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    user = db.relationship('User', back_populates='read_marks')
+    topic = db.relationship('Topic', back_populates='read_marks')
+
+    @staticmethod
+    def horizon():
+        """READ_MARK_DAYS 天之前的动态一律算已读，更早的已读记录没有用处，可以清理。"""
+        return datetime.utcnow() - timedelta(days=current_app.config['READ_MARK_DAYS'])
+
+    @staticmethod
+    def backfill_activity():
+        """给还没有 last_activity 的主题补上：主题时间和最后一条公开回帖时间中较晚的一个。"""
+        last_post = db.session.query(db.func.max(Post.timestamp)).\
+            filter(Post.topic_id == Topic.id, Post.saved == False, Post.deleted == False).as_scalar()
+        count = Topic.query.filter(Topic.last_activity == None).update(
+            {Topic.last_activity: db.case([(last_post > Topic.timestamp, last_post)], else_=Topic.timestamp)},
+            synchronize_session=False)
+        db.session.commit()
+        return count
+
+    @staticmethod
+    def convert_views():
+        """把旧的 View 记录转换成已读记录，返回转换的条数。
+
+        View 只记了"读过"、没有时间，旧版里读过的主题以后一直算已读，所以已读位置取主题当前的 last_activity，
+        转换前后每个主题的已读状态不变。早于 READ_MARK_DAYS 的不再保存，其余并入各组的水位。
+        """
+        GroupReadMark.__table__.create(db.engine, checkfirst=True)
+        ReadMark.__table__.create(db.engine, checkfirst=True)
+        ReadMark.backfill_activity()
+        exists = db.session.query(ReadMark.user_id).filter(ReadMark.user_id == View.reader_id,
+                                                           ReadMark.topic_id == View.readed_id).exists()
+        rows = db.session.query(View.reader_id, View.readed_id, Topic.last_activity).\
+            join(Topic, Topic.id == View.readed_id).filter(~exists, Topic.last_activity > ReadMark.horizon())
+        result = db.session.execute(ReadMark.__table__.insert().
+                                    from_select(['user_id', 'topic_id', 'timestamp'], rows))
+        View.query.delete(synchronize_session=False)
+        db.session.commit()
+        pairs = db.session.query(ReadMark.user_id, Topic.group_id).join(Topic, Topic.id == ReadMark.topic_id).\
+            distinct().all()
+        for user_id, group_id in pairs:
+            User.advance_read_mark(user_id, group_id)
+            db.session.commit()
+        return result.rowcount
+
+    @staticmethod
+    def prune(batch_size=1000):
+        """删掉一批早于 READ_MARK_DAYS 的已读记录，返回删掉的条数，返回 0 说明已经清理完。"""
+        horizon = ReadMark.horizon()
+        # 按时间顺序一批批删，每批单独提交，不长时间锁表
+        edge = db.session.query(ReadMark.timestamp).filter(ReadMark.timestamp < horizon).\
+            order_by(ReadMark.timestamp).offset(batch_size - 1).limit(1).scalar()
+        if edge is None:  # 剩下的不到一批，组水位也一起清理
+            count = ReadMark.query.filter(ReadMark.timestamp < horizon).delete(synchronize_session=False)
+            count += GroupReadMark.query.filter(GroupReadMark.timestamp < horizon).delete(synchronize_session=False)
+        else:
+            count = ReadMark.query.filter(ReadMark.timestamp <= edge).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+
 #relationship object
 class Notice(db.Model):
+    __table_args__ = (
+        db.Index('ix_notice_receiver_timestamp', 'receiver_id', 'timestamp'),
+    )
+
     noticed_id = db.Column(db.Integer, db.ForeignKey('topic.id'), primary_key=True)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    last_emailed = db.Column(db.DateTime)  # 汇总邮件已经包含到的最后一条回帖的时间
 
     noticed = db.relationship('Topic', back_populates='receivers', lazy='joined')
     receiver = db.relationship('User', back_populates='notices', lazy='joined')
@@ -191,6 +358,15 @@ class Notice(db.Model):
 
 @whooshee.register_model('name', 'body')
 class Topic(db.Model):
+    # 复合索引对应热点查询的 saved/deleted 过滤加时间排序
+    __table_args__ = (
+        db.Index('ix_topic_group_visible', 'group_id', 'saved', 'deleted', 'top', 'timestamp'),
+        db.Index('ix_topic_author_visible', 'author_id', 'saved', 'deleted', 'timestamp'),
+        db.Index('ix_topic_deleted_timestamp', 'deleted', 'timestamp'),
+        db.Index('ix_topic_report_time', 'report_time'),
+        db.Index('ix_topic_group_activity', 'group_id', 'last_activity'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(60), nullable=False)
     body = db.Column(db.Text, nullable=False)
@@ -206,6 +382,11 @@ class Topic(db.Model):
     last_post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
     post_count = db.Column(db.Integer, default=0)
     create_time = db.Column(db.DateTime, default=datetime.utcnow, index=True)  #创建时间
+    version = db.Column(db.Integer, default=0, server_default='0')  # 页面片段缓存的版本号
+    # 主题或回帖最近一次发表、修改的时间，由 touch_topic_activity 维护，已读判断只和它比较
+    last_activity = db.Column(db.DateTime)
+
+    _unversioned = ('read_time', 'report_time', 'post_count', 'last_post_id', 'last_activity')  # 不影响主题片段渲染的列
 
     #group = db.relationship('Forum', back_populates='topics')
     posts = db.relationship('Post', backref='topic', cascade='all', lazy='dynamic',
@@ -215,11 +396,30 @@ class Topic(db.Model):
     files = db.relationship('File', back_populates='topic', cascade='all')
     collectors = db.relationship('Collect', back_populates='collected', cascade='all')
     readers = db.relationship('View', back_populates='readed', cascade='all')
+    read_marks = db.relationship('ReadMark', back_populates='topic', cascade='all')
     last_post = db.relationship('Post', backref='last_post', uselist=False, foreign_keys=[last_post_id])
 
     def __init__(self, **kwargs):
         super(Topic, self).__init__(**kwargs)
 
+    @property
+    def activity(self):
+        return self.last_activity or self.timestamp
+
+    @staticmethod
+    def list_options():
+        # 主题列表随主题一起join加载作者、所在组和最后回帖（含其作者），模板里不再逐行查询
+        return (db.joinedload(Topic.author), db.joinedload(Topic.group),
+                db.joinedload(Topic.last_post).joinedload(Post.author))
+
+    @staticmethod
+    def receiver_counts(topic_ids):
+        if not topic_ids:
+            return {}
+        rows = db.session.query(Notice.noticed_id, db.func.count(Notice.receiver_id)).\
+            filter(Notice.noticed_id.in_(topic_ids)).group_by(Notice.noticed_id)
+        return dict(rows)
+
     def get_last_post(self):
         if self.posts:
             last_post = Post.query.with_parent(self).filter_by(saved=False, deleted=False).\
@@ -247,6 +447,13 @@ class Topic(db.Model):
 
 @whooshee.register_model('title', 'body')
 class Post(db.Model):
+    __table_args__ = (
+        db.Index('ix_post_topic_visible', 'topic_id', 'saved', 'deleted', 'timestamp'),
+        db.Index('ix_post_author_visible', 'author_id', 'saved', 'deleted', 'timestamp'),
+        db.Index('ix_post_deleted_timestamp', 'deleted', 'timestamp'),
+        db.Index('ix_post_report_time', 'report_time'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60), nullable=False)
     body = db.Column(db.Text, nullable=False)
@@ -258,6 +465,9 @@ class Post(db.Model):
     replied_id = db.Column(db.Integer, db.ForeignKey('post.id'))
     deleted = db.Column(db.Boolean, default=False)  #deleted=False,说明没有删除标记
     create_time = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # 创建时间
+    version = db.Column(db.Integer, default=0, server_default='0')  # 页面片段缓存的版本号
+
+    _unversioned = ('report_time',)  # 不影响回帖片段渲染的列
 
     files = db.relationship('File', back_populates='post', cascade='all')
     author = db.relationship('User', back_populates='posts')
@@ -266,25 +476,54 @@ class Post(db.Model):
     replied = db.relationship('Post', back_populates='replies', remote_side=[id])
 
 
+class Blob(db.Model):
+    """按内容哈希保存的附件文件，内容相同的附件共用一个，ref_count 记录引用它的 File 数。"""
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), unique=True, nullable=False)
+    filename = db.Column(db.String(64))
+    filename_s = db.Column(db.String(64))
+    size = db.Column(db.Integer)
+    ref_count = db.Column(db.Integer, default=0, server_default='0')
+
+    files = db.relationship('File', back_populates='blob')
+
+
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(128))  # 上传时的文件名，只用于显示
     filename = db.Column(db.String(64))
     filename_s = db.Column(db.String(64))
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id'), index=True)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), index=True)
     topic_id = db.Column(db.Integer, db.ForeignKey('topic.id'), index=True)
 
     post = db.relationship('Post', back_populates='files')
     topic = db.relationship('Topic', back_populates='files')
+    blob = db.relationship('Blob', back_populates='files')
+
+
+def _remove_uploads(*filenames):
+    for filename in filenames:
+        if filename is not None:  #filename_s may be None
+            storage.remove('UPLOAD_PATH', filename)
 
 
 @db.event.listens_for(File, 'after_delete', named=True)
 def delete_files(**kwargs):
     target = kwargs['target']
-    for filename in [target.filename, target.filename_s]:
-        if filename is not None:  #filename_s may be None
-            path = os.path.join(current_app.config['UPLOAD_PATH'], filename)
-            if os.path.exists(path):
-                os.remove(path)
+    if target.blob_id is None:  # 去重之前上传的附件独占文件
+        _remove_uploads(target.filename, target.filename_s)
+        return
+    # 共享的文件只在最后一个引用删除时才删
+    connection = kwargs['connection']
+    blobs = Blob.__table__
+    connection.execute(blobs.update().where(blobs.c.id == target.blob_id).
+                       values(ref_count=blobs.c.ref_count - 1))
+    blob = connection.execute(db.select([blobs.c.filename, blobs.c.filename_s, blobs.c.ref_count]).
+                              where(blobs.c.id == target.blob_id)).first()
+    if blob is not None and blob.ref_count <= 0:
+        connection.execute(blobs.delete().where(blobs.c.id == target.blob_id))
+        _remove_uploads(blob.filename, blob.filename_s)
 
 
 @whooshee.register_model('username', 'name')
@@ -305,6 +544,10 @@ class User(UserMixin, db.Model):
     receive_collect_notification = db.Column(db.Boolean, default=True)
     receive_post_notification = db.Column(db.Boolean, default=True)
     receive_notice_notification = db.Column(db.Boolean, default=True)
+    # 订阅帖子的新回帖邮件：instant/digest/off。默认逐条发送，汇总要用户在设置里自己选（set_notice_email），
+    # 汇总只有 flask send-digests 定时运行时才会发出去
+    notice_email = db.Column(db.String(10), default='instant', server_default='instant')
+    unread_notification_count = db.Column(db.Integer, default=0, server_default='0')  #未读通知数
 
     role_id = db.Column(db.Integer, db.ForeignKey('role.id'))
     confirmed = db.Column(db.Boolean, default=False)
@@ -312,13 +555,20 @@ class User(UserMixin, db.Model):
 
     #post_c_p = db.Column(db.Integer, default=0)  #发布的回帖数
     topic_c_p = db.Column(db.Integer, default=0)  #发布的帖子数
+    version = db.Column(db.Integer, default=0, server_default='0')  # 页面片段缓存的版本号
+
+    _unversioned = ('password_hash', 'unread_notification_count', 'receive_collect_notification',
+                    'receive_post_notification', 'receive_notice_notification', 'notice_email')  # 不影响片段渲染的列
 
     posts = db.relationship('Post', back_populates='author', cascade='all')
     role = db.relationship('Role', back_populates='users')
     admin_groups = db.relationship('Forum', back_populates='admin')
-    notifications = db.relationship('Notification', back_populates='receiver', cascade='all')
+    notifications = db.relationship('Notification', back_populates='receiver', cascade='all',
+                                    foreign_keys='Notification.receiver_id')
     collections = db.relationship('Collect', back_populates='collector', cascade='all')
     reads = db.relationship('View', back_populates='reader', cascade='all')
+    read_marks = db.relationship('ReadMark', back_populates='user', cascade='all')
+    group_read_marks = db.relationship('GroupReadMark', back_populates='user', cascade='all')
     notices = db.relationship('Notice', back_populates='receiver', cascade='all')
     topics = db.relationship('Topic', back_populates='author', cascade='all')
 
@@ -330,6 +580,8 @@ class User(UserMixin, db.Model):
     def generate_avatar(self):
         avatar = Identicon()
         filenames = avatar.generate(text=uuid.uuid4().hex)
+        for filename in filenames:
+            storage.adopt('AVATARS_SAVE_PATH', filename)  # Identicon 写在目录根下，挪进分片目录
         self.avatar_s = filenames[0]
         self.avatar_m = filenames[1]
         self.avatar_l = filenames[2]
@@ -357,9 +609,13 @@ class User(UserMixin, db.Model):
     def is_active(self):
         return self.active
 
+    @property
+    def permission_mask(self):
+        return Role.get_permission_mask(self.role_id)
+
     def can(self, permission_name):
-        permission = Permission.query.filter_by(name=permission_name).first()
-        return permission is not None and self.role is not None and permission in self.role.permissions
+        bit = Role.get_permission_bit(permission_name)
+        return bit != 0 and self.permission_mask & bit == bit
 
     def collect(self, topic):
         if not self.is_collecting(topic):
@@ -376,14 +632,97 @@ class User(UserMixin, db.Model):
     def is_collecting(self, topic):
         return Collect.query.with_parent(self).filter_by(collected_id=topic.id).first() is not None
 
+    def read_states(self, topic_ids):
+        """一次查询返回 {topic_id: (是否已读, 上次访问后的新回帖数)}。
+
+        已读位置取主题的例外记录、所在组水位和 READ_MARK_DAYS 三者中最晚的一个，last_activity 晚于它就算未读。
+        """
+        if not topic_ids:
+            return {}
+        horizon = ReadMark.horizon()
+        topic_mark = db.func.coalesce(ReadMark.timestamp, horizon)
+        group_mark = db.func.coalesce(GroupReadMark.timestamp, horizon)
+        mark = db.case([(topic_mark > group_mark, topic_mark)], else_=group_mark)
+        mark = db.case([(mark > horizon, mark)], else_=horizon)
+        rows = db.session.query(Topic.id, db.func.coalesce(Topic.last_activity, Topic.timestamp), mark,
+                                db.func.count(Post.id)).\
+            outerjoin(ReadMark, db.and_(ReadMark.topic_id == Topic.id, ReadMark.user_id == self.id)).\
+            outerjoin(GroupReadMark, db.and_(GroupReadMark.group_id == Topic.group_id,
+                                             GroupReadMark.user_id == self.id)).\
+            outerjoin(Post, db.and_(Post.topic_id == Topic.id, Post.saved == False, Post.deleted == False,
+                                    Post.timestamp > mark)).\
+            filter(Topic.id.in_(topic_ids)).\
+            group_by(Topic.id, Topic.last_activity, Topic.timestamp, ReadMark.timestamp, GroupReadMark.timestamp)
+        states = {}
+        for topic_id, activity, read_at, new_count in rows:
+            states[topic_id] = (activity <= read_at and new_count == 0, new_count)
+        return states
+
+    def read_watermark(self, group_id):
+        """组水位：last_activity 不晚于它的主题都算读过。"""
+        mark = GroupReadMark.query.get((self.id, group_id))
+        horizon = ReadMark.horizon()
+        return max(mark.timestamp, horizon) if mark is not None else horizon
+
     def is_reading(self, topic):
-        return View.query.with_parent(self).filter_by(readed_id=topic.id).first() is not None
+        # 只按主键查组水位和例外记录，看主题页时不做聚合查询
+        activity = topic.activity
+        if activity is None or activity <= self.read_watermark(topic.group_id):
+            return True
+        mark = ReadMark.query.get((self.id, topic.id))
+        return mark is not None and mark.timestamp >= activity
 
     def read(self, topic):
-        if not self.is_reading(topic):
-            read = View(reader=self, readed=topic)
-            db.session.add(read)
-            db.session.commit()
+        # 只有主题在水位之上有新动态时才写，写完试着把组水位往前推
+        if topic.id is None:
+            db.session.flush()
+        if self.is_reading(topic):
+            return
+        mark = ReadMark.query.get((self.id, topic.id))
+        if mark is None:
+            mark = ReadMark(user_id=self.id, topic_id=topic.id)
+            db.session.add(mark)
+        mark.timestamp = max(datetime.utcnow(), topic.activity)
+        db.session.flush()
+        User.advance_read_mark(self.id, topic.group_id)
+        db.session.commit()
+
+    @staticmethod
+    def advance_read_mark(user_id, group_id):
+        """把组水位推到最早一个未读主题之前，水位以下的例外记录随之删除。不提交。"""
+        mark = GroupReadMark.query.get((user_id, group_id))
+        watermark = max(mark.timestamp, ReadMark.horizon()) if mark is not None else ReadMark.horizon()
+        # 只看水位之上有动态的主题，走 (group_id, last_activity) 索引，数量受 READ_MARK_DAYS 限制
+        above = db.session.query(Topic.last_activity).\
+            filter(Topic.group_id == group_id, Topic.saved == False, Topic.deleted == False,
+                   Topic.last_activity > watermark)
+        oldest_unread = above.outerjoin(ReadMark, db.and_(ReadMark.topic_id == Topic.id, ReadMark.user_id == user_id)).\
+            filter(db.or_(ReadMark.timestamp == None, ReadMark.timestamp < Topic.last_activity)).\
+            with_entities(db.func.min(Topic.last_activity)).scalar()
+        if oldest_unread is not None:
+            above = above.filter(Topic.last_activity < oldest_unread)
+        new_watermark = above.with_entities(db.func.max(Topic.last_activity)).scalar()
+        if new_watermark is None:
+            return
+        if mark is None:
+            mark = GroupReadMark(user_id=user_id, group_id=group_id)
+            db.session.add(mark)
+        mark.timestamp = new_watermark
+        covered = db.session.query(Topic.id).filter(Topic.group_id == group_id, Topic.last_activity <= new_watermark)
+        ReadMark.query.filter(ReadMark.user_id == user_id, ReadMark.topic_id.in_(covered.subquery())).\
+            delete(synchronize_session=False)
+
+    def read_group(self, group):
+        # 整组标为已读：组水位推到现在，组内的例外记录一并删除
+        mark = GroupReadMark.query.get((self.id, group.id))
+        if mark is None:
+            mark = GroupReadMark(user_id=self.id, group_id=group.id)
+            db.session.add(mark)
+        mark.timestamp = datetime.utcnow()
+        topic_ids = db.session.query(Topic.id).filter(Topic.group_id == group.id)
+        ReadMark.query.filter(ReadMark.user_id == self.id, ReadMark.topic_id.in_(topic_ids.subquery())).\
+            delete(synchronize_session=False)
+        db.session.commit()
 
     def is_noticing(self, topic):
         return Notice.query.with_parent(self).filter_by(noticed_id=topic.id).first() is not None
@@ -400,6 +739,50 @@ class User(UserMixin, db.Model):
             db.session.delete(notice)
             db.session.commit()
 
+    def set_notice_email(self, mode):
+        if mode == 'digest' and self.notice_email != 'digest':
+            # 切换到汇总时从现在算起，不把以前的回帖补发一遍
+            Notice.query.with_parent(self).update({'last_emailed': datetime.utcnow()}, synchronize_session=False)
+        self.notice_email = mode
+
+    def read_notification(self, notification):
+        # 条件更新：同一条通知被并发标记已读时，未读数只减一次
+        changed = Notification.query.filter_by(id=notification.id, is_read=False).\
+            update({'is_read': True, 'unread_key': None}, synchronize_session=False)
+        if changed:
+            self.unread_notification_count = User.unread_notification_count - 1
+        db.session.commit()
+
+    def read_all_notifications(self):
+        # 一条 UPDATE 全部标记已读，按实际改动的行数减未读数，期间新到的通知仍算未读
+        changed = Notification.query.filter_by(receiver_id=self.id, is_read=False).\
+            update({'is_read': True, 'unread_key': None}, synchronize_session=False)
+        self.unread_notification_count = User.unread_notification_count - changed
+        db.session.commit()
+
+    def delete_notification(self, notification):
+        # 和 read_notification 一样按条件删除，只有真正删掉未读通知的请求才减计数，并发删除时不会多减
+        unread = Notification.query.filter_by(id=notification.id, is_read=False).delete(synchronize_session=False)
+        if unread:
+            self.unread_notification_count = User.unread_notification_count - 1
+        else:
+            Notification.query.filter_by(id=notification.id).delete(synchronize_session=False)
+        db.session.commit()
+
+    def delete_all_notifications(self):
+        unread = Notification.query.filter_by(receiver_id=self.id, is_read=False).delete(synchronize_session=False)
+        Notification.query.filter_by(receiver_id=self.id).delete(synchronize_session=False)
+        self.unread_notification_count = User.unread_notification_count - unread
+        db.session.commit()
+
+    @staticmethod
+    def repair_unread_count():
+        unread = db.session.query(db.func.count(Notification.id)).\
+            filter(Notification.receiver_id == User.id, Notification.is_read == False).as_scalar()
+        count = User.query.update({User.unread_notification_count: unread}, synchronize_session=False)
+        db.session.commit()
+        return count
+
     def publish_post_count(self):
         post_count = Post.query.with_parent(self).filter_by(saved=False, deleted=False).count()
         return post_count
@@ -430,16 +813,225 @@ def delete_avatars(**kwargs):
     target = kwargs['target']
     for filename in [target.avatar_s, target.avatar_m, target.avatar_l, target.avatar_raw]:
         if filename is not None:  # avatar_raw may be None
-            path = os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename)
-            if os.path.exists(path):  # not every filename map a unique file
-                os.remove(path)
+            storage.remove('AVATARS_SAVE_PATH', filename)  # not every filename map a unique file
+
+
+def touch_topic_activity(connection, topic_id, timestamp):
+    # 用 SQL 条件更新，只往后推；并发发表回帖时不会被较早的时间覆盖
+    table = Topic.__table__
+    connection.execute(table.update().where(table.c.id == topic_id).
+                       where(db.or_(table.c.last_activity == None, table.c.last_activity < timestamp)).
+                       values(last_activity=timestamp))
+
+
+@db.event.listens_for(Topic, 'after_insert', named=True)
+def touch_topic(**kwargs):
+    target = kwargs['target']
+    if not target.saved and not target.deleted:
+        touch_topic_activity(kwargs['connection'], target.id, target.timestamp)
+
+
+@db.event.listens_for(Topic, 'after_update', named=True)
+def touch_updated_topic(**kwargs):
+    state = db.inspect(kwargs['target'])
+    # 浏览数、回帖数之类的更新不算主题的新动态
+    if any(state.attrs[attr].history.has_changes() for attr in ('timestamp', 'saved', 'deleted')):
+        touch_topic(**kwargs)
+
+
+@db.event.listens_for(Post, 'after_insert', named=True)
+@db.event.listens_for(Post, 'after_update', named=True)
+def touch_topic_on_post(**kwargs):
+    target = kwargs['target']
+    if not target.saved and not target.deleted and target.topic_id is not None:
+        touch_topic_activity(kwargs['connection'], target.topic_id, target.timestamp)
+
+
+@db.event.listens_for(Topic.body, 'set', named=True, retval=True)
+@db.event.listens_for(Post.body, 'set', named=True, retval=True)
+def rewrite_body_images(**kwargs):
+    return responsive_images(kwargs['value'])  # 正文里上传的图片改成按屏幕宽度选择的 srcset
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def bump_versions(session, flush_context, instances):
+    # 片段缓存以版本号为键：影响渲染的列有改动、或者增删了附件，就递增版本号，旧片段不再命中
+    targets = set()
+    for target in session.dirty:
+        if isinstance(target, (Forum, Topic, Post, User)):
+            state = db.inspect(target)
+            ignored = set(getattr(target, '_unversioned', ())) | {'version'}
+            if any(state.attrs[attr.key].history.has_changes() for attr in state.mapper.column_attrs
+                   if attr.key not in ignored):
+                targets.add(target)
+    for target in list(session.new) + list(session.deleted):
+        if isinstance(target, File):
+            parent = target.post or target.topic
+            if parent is not None and parent not in session.deleted:
+                targets.add(parent)
+    for target in targets:
+        target.version = (target.version or 0) + 1
 
 
 class Notification(db.Model):
+    """站内通知。只存事件类型和相关对象，显示时再渲染；同一对象上没读的同类事件合并成一条，count 记次数。
+
+    kind：post 主题有新回帖，collect 主题被收藏，notice 主题被订阅，reported_post/reported_topic 被举报达到上限，
+    group_admin 被设为小组管理员，legacy 是无法转换的旧通知，仍然显示 message 里预先渲染的 HTML。
+    """
+    __table_args__ = (
+        db.Index('ix_notification_receiver_timestamp', 'receiver_id', 'timestamp'),
+        db.Index('ix_notification_receiver_read', 'receiver_id', 'is_read'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    message = db.Column(db.Text, nullable=False)
+    kind = db.Column(db.String(20))
+    count = db.Column(db.Integer, default=1, server_default='1')
+    message = db.Column(db.Text)
     is_read = db.Column(db.Boolean, default=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # 相关对象删除后通知保留，由数据库把引用置空，显示为已删除
+    actor_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))  # 最近一次触发的用户
+    topic_id = db.Column(db.Integer, db.ForeignKey('topic.id', ondelete='SET NULL'))
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='SET NULL'))
+    group_id = db.Column(db.Integer, db.ForeignKey('forum.id', ondelete='SET NULL'))
+    # 未读时是 接收者:类型:主题:回帖:组（见 unread_key_for），标记已读时置空。唯一约束保证同一对象上的同类通知
+    # 只有一条未读，并发的两个请求不会各插入一条；NULL 不受唯一约束限制，已读通知不受影响。MySQL 没有部分索引，所以用单独的列
+    unread_key = db.Column(db.String(80), unique=True)
+
+    receiver = db.relationship('User', back_populates='notifications', foreign_keys=[receiver_id])
+    # 只有多对一的一侧：删除主题、回帖时 ORM 不用先加载它们的通知
+    actor = db.relationship('User', foreign_keys=[actor_id])
+    topic = db.relationship('Topic')
+    post = db.relationship('Post')
+    group = db.relationship('Forum')
 
-    receiver = db.relationship('User', back_populates='notifications')
+    @staticmethod
+    def unread_key_for(receiver_id, kind, topic_id=None, post_id=None, group_id=None):
+        return ':'.join('' if value is None else str(value) for value in (receiver_id, kind, topic_id, post_id, group_id))
+
+    @staticmethod
+    def _unread_key_expression():
+        # 和 unread_key_for 拼出同样的字符串，给已有的通知补上 unread_key 用
+        parts = [db.func.coalesce(db.cast(column, db.String), '') for column in
+                 (Notification.receiver_id, Notification.kind, Notification.topic_id, Notification.post_id,
+                  Notification.group_id)]
+        expression = parts[0]
+        for part in parts[1:]:
+            expression = expression + ':' + part
+        return expression
+
+    @staticmethod
+    def _parse_message(message):
+        # 旧通知由 noticifations.py 里固定的几句话生成，按链接和关键字认出类型和对象
+        def find(pattern):
+            match = re.search(r'href="[^"]*/%s/([^"/]+)"' % pattern, message)
+            return match.group(1) if match else None
+
+        topic_id, post_id, group_id, username = find('show_topic'), find('post'), find('group'), find('user')
+        if '有新的回帖' in message and topic_id:
+            return dict(kind='post', topic_id=int(topic_id))
+        if '收藏' in message and topic_id:
+            return dict(kind='collect', topic_id=int(topic_id), actor_username=username)
+        if '订阅' in message and topic_id:
+            return dict(kind='notice', topic_id=int(topic_id), actor_username=username)
+        if '被举报已达上限' in message and post_id:
+            return dict(kind='reported_post', post_id=int(post_id))
+        if '被举报已达上限' in message and topic_id:
+            return dict(kind='reported_topic', topic_id=int(topic_id))
+        if '管理员' in message and group_id:
+            return dict(kind='group_admin', group_id=int(group_id))
+        return dict(kind='legacy')
+
+    @staticmethod
+    def convert_messages(batch_size=1000):
+        """把预先渲染成 HTML 的旧通知转换成结构化的记录，再把同一对象上的同类通知合并，返回 (转换数, 合并掉的行数)。
+
+        分批提交，中断后重新运行会接着处理。
+        """
+        converted = 0
+        while True:
+            notifications = Notification.query.filter(Notification.kind == None).\
+                order_by(Notification.id).limit(batch_size).all()
+            if not notifications:
+                break
+            parsed = [Notification._parse_message(notification.message) for notification in notifications]
+            # 被删掉的对象不再引用
+            topic_ids = set(id_ for id_, in db.session.query(Topic.id).filter(
+                Topic.id.in_([p['topic_id'] for p in parsed if p.get('topic_id')] or [0])))
+            post_ids = set(id_ for id_, in db.session.query(Post.id).filter(
+                Post.id.in_([p['post_id'] for p in parsed if p.get('post_id')] or [0])))
+            group_ids = set(id_ for id_, in db.session.query(Forum.id).filter(
+                Forum.id.in_([p['group_id'] for p in parsed if p.get('group_id')] or [0])))
+            users = dict(db.session.query(User.username, User.id).filter(
+                User.username.in_([p['actor_username'] for p in parsed if p.get('actor_username')] or [''])))
+            for notification, fields in zip(notifications, parsed):
+                notification.kind = fields['kind']
+                notification.count = 1
+                notification.topic_id = fields.get('topic_id') if fields.get('topic_id') in topic_ids else None
+                notification.post_id = fields.get('post_id') if fields.get('post_id') in post_ids else None
+                notification.group_id = fields.get('group_id') if fields.get('group_id') in group_ids else None
+                notification.actor_id = users.get(fields.get('actor_username'))
+                if notification.kind != 'legacy':
+                    notification.message = None
+            db.session.commit()
+            converted += len(notifications)
+        return converted, Notification.coalesce_all()
+
+    @staticmethod
+    def purge_read(before, batch_size=1000, archive=False):
+        """删除 before 之前的已读通知，一次最多 batch_size 条，archive 为真时先复制到 notification_archive。
+
+        返回这一批处理的条数，返回 0 说明已经处理完。每批单独提交，不会长时间锁表。
+        """
+        ids = [id_ for id_, in db.session.query(Notification.id).
+               filter(Notification.is_read == True, Notification.timestamp < before).limit(batch_size)]
+        if not ids:
+            return 0
+        if archive:
+            names = [column.name for column in NotificationArchive.__table__.columns if column.name != 'archived_at']
+            source = db.select([Notification.__table__.c[name] for name in names]).where(Notification.id.in_(ids))
+            db.session.execute(NotificationArchive.__table__.insert().from_select(names, source))
+        Notification.query.filter(Notification.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        return len(ids)
+
+    @staticmethod
+    def coalesce_all():
+        """把同一用户、同一对象、同一已读状态的同类通知合并成一条，再给未读的补上 unread_key，返回删掉的行数。"""
+        key = [Notification.receiver_id, Notification.kind, Notification.topic_id, Notification.post_id,
+               Notification.group_id, Notification.is_read]
+        groups = db.session.query(db.func.max(Notification.id), db.func.sum(Notification.count),
+                                  db.func.max(Notification.timestamp), *key).\
+            filter(Notification.kind != 'legacy').group_by(*key).having(db.func.count(Notification.id) > 1).all()
+        removed = 0
+        for keep_id, count, timestamp, *values in groups:
+            Notification.query.filter_by(id=keep_id).update({'count': count, 'timestamp': timestamp},
+                                                             synchronize_session=False)
+            removed += Notification.query.filter(Notification.id != keep_id,
+                                                 *[column == value for column, value in zip(key, values)]).\
+                delete(synchronize_session=False)
+            db.session.commit()
+        Notification.query.filter(Notification.is_read == False, Notification.kind != 'legacy',
+                                  Notification.unread_key == None).\
+            update({'unread_key': Notification._unread_key_expression()}, synchronize_session=False)
+        db.session.commit()
+        User.repair_unread_count()
+        return removed
+
+
+class NotificationArchive(db.Model):
+    """超过保留期归档的已读通知，列和 Notification 相同，不带外键，相关对象删除不受影响。"""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    kind = db.Column(db.String(20))
+    count = db.Column(db.Integer)
+    message = db.Column(db.Text)
+    is_read = db.Column(db.Boolean)
+    timestamp = db.Column(db.DateTime)
+    receiver_id = db.Column(db.Integer, index=True)
+    actor_id = db.Column(db.Integer)
+    topic_id = db.Column(db.Integer)
+    post_id = db.Column(db.Integer)
+    group_id = db.Column(db.Integer)
+    archived_at = db.Column(db.DateTime, server_default=db.func.now())  # INSERT ... SELECT 时由数据库填写
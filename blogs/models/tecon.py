@@ -1,9 +1,9 @@
 # coding=utf-8
-import os
 from datetime import datetime
-from flask import current_app
 
 from blogs.extensions import db
+from blogs import storage
+from blogs.images import responsive_images
 
 
 class Photo(db.Model):
@@ -19,9 +19,7 @@ class Photo(db.Model):
 def delete_photos(**kwargs):
     target = kwargs['target']
     for filename in [target.filename, target.filename_s]:
-        path = os.path.join(current_app.config['TECON_PATH'], filename)
-        if os.path.exists(path):                # not every filename map a unique file
-            os.remove(path)
+        storage.remove('TECON_PATH', filename)                # not every filename map a unique file
 
 
 class Item(db.Model):
@@ -36,6 +34,10 @@ class Item(db.Model):
     series = db.relationship('Series', back_populates='items')
 
 
+@db.event.listens_for(Item.body, 'set', named=True, retval=True)
+def rewrite_body_images(**kwargs):
+    return responsive_images(kwargs['value'])
+
 class Series(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(10))
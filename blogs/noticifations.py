@@ -1,55 +1,58 @@
-from flask import url_for
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
 
 from blogs.extensions import db
-from blogs.models.blogs import Notification
+from blogs.events import publish_unread_count
+from blogs.models.blogs import Notification, User
+
+
+def _coalesce(key, actor):
+    return Notification.query.filter_by(unread_key=key).\
+        update({'count': Notification.count + 1, 'timestamp': datetime.utcnow(),
+                'actor_id': actor.id if actor else None}, synchronize_session=False)
+
+
+def _push_notification(receiver, kind, actor=None, topic=None, post=None, group=None):
+    # 同一对象上还没读的同类通知只留一条：次数加一，时间和触发的用户换成最新的，未读数不变
+    target = dict(receiver_id=receiver.id, kind=kind, topic_id=topic.id if topic else None,
+                  post_id=post.id if post else None, group_id=group.id if group else None)
+    key = Notification.unread_key_for(**target)
+    if _coalesce(key, actor):
+        db.session.commit()
+        return
+    db.session.add(Notification(actor_id=actor.id if actor else None, unread_key=key, **target))
+    receiver.unread_notification_count = User.unread_notification_count + 1  # 原子自增，避免并发丢失
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 并发的请求在上面的 UPDATE 之后插入了同一条未读通知，唯一约束挡下了这一条，改为合并进去
+        db.session.rollback()
+        _coalesce(key, actor)
+        db.session.commit()
+        return
+    publish_unread_count(receiver)
 
 
 def push_group_admin_notification(group):
-    message = '您已被设为 <a href="%s">%s</a> 小组的管理员。' % (url_for('main.show_group', group_id=group.id), group.name)
-    notification = Notification(message=message, receiver=group.admin)
-    db.session.add(notification)
-    db.session.commit()
+    _push_notification(group.admin, 'group_admin', group=group)
 
 
 def push_post_notification(post, receiver):
-    message = '您发布的这个<a href="%s">%s</a>有新的回帖。' % \
-              (url_for('main.show_topic', topic_id=post.topic_id), post.topic.name)
-    notification = Notification(message=message, receiver=receiver)
-    db.session.add(notification)
-    db.session.commit()
+    _push_notification(receiver, 'post', actor=post.author, topic=post.topic)
 
 
 def push_collect_notification(topic, user):
-    message = '您发表的<a href="%s">%s</a>已被<a href="%s">%s</a>收藏。' % \
-              (url_for('main.show_topic', topic_id=topic.id), topic.name, url_for('user.index', username=user.username),
-               user.username)
-    notification = Notification(message=message, receiver=topic.author)
-    db.session.add(notification)
-    db.session.commit()
+    _push_notification(topic.author, 'collect', actor=user, topic=topic)
 
 
 def push_notice_notification(topic, user):
-    message = '您发布的<a href="%s">%s</a>已被<a href="%s">%s</a>订阅。' % \
-              (url_for('main.show_topic', topic_id=topic.id), topic.name, url_for('user.index', username=user.username),
-               user.username)
-    notification = Notification(message=message, receiver=topic.author)
-    db.session.add(notification)
-    db.session.commit()
+    _push_notification(topic.author, 'notice', actor=user, topic=topic)
 
 
 def push_max_reported_post_notification(post):
-    message = '您发布的<a href="%s">%s</a>被举报已达上限，<a href="%s">编辑</a>？' % \
-              (url_for('main.show_post', post_id=post.id), post.title,
-               url_for('main.edit_post', post_id=post.id))
-    notification = Notification(message=message, receiver=post.author)
-    db.session.add(notification)
-    db.session.commit()
+    _push_notification(post.author, 'reported_post', post=post)
 
 
 def push_max_reported_topic_notification(topic):
-    message = '您发布的<a href="%s">%s</a>被举报已达上限，<a href="%s">编辑</a>？' % \
-              (url_for('main.show_topic', topic_id=topic.id), topic.name,
-               url_for('main.edit_topic', topic_id=topic.id))
-    notification = Notification(message=message, receiver=topic.author)
-    db.session.add(notification)
-    db.session.commit()
\ No newline at end of file
+    _push_notification(topic.author, 'reported_topic', topic=topic)
@@ -0,0 +1,70 @@
+from datetime import datetime
+
+from flask import request
+
+from blogs.extensions import db
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(value, item_id):
+    return '%s-%d' % (value.strftime(CURSOR_FORMAT), item_id)
+
+
+def decode_cursor(cursor):
+    try:
+        value, item_id = cursor.split('-')
+        return datetime.strptime(value, CURSOR_FORMAT), int(item_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+class KeysetPagination(object):
+    """按 (时间, id) 翻页，利用复合索引直接定位，不需要 OFFSET 扫描，也不做 COUNT(*)。
+
+    after/before 是上一页返回的游标，两者都为空时取第一页。
+    """
+
+    def __init__(self, query, column, id_column, per_page, after=None, before=None, descending=True):
+        self.per_page = per_page
+        before_key = decode_cursor(before)
+        backwards = before_key is not None
+        key = before_key if backwards else decode_cursor(after)
+        # 往前翻时按相反方向取数据，取出后再倒过来
+        scan_desc = descending != backwards
+
+        if key is not None:
+            value, key_id = key
+            if scan_desc:
+                query = query.filter(db.or_(column < value, db.and_(column == value, id_column < key_id)))
+            else:
+                query = query.filter(db.or_(column > value, db.and_(column == value, id_column > key_id)))
+        if scan_desc:
+            query = query.order_by(column.desc(), id_column.desc())
+        else:
+            query = query.order_by(column.asc(), id_column.asc())
+
+        items = query.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if backwards:
+            items.reverse()
+            self.has_prev, self.has_next = more, True
+        else:
+            self.has_prev, self.has_next = key is not None, more
+        self.has_prev = self.has_prev and bool(items)
+        self.has_next = self.has_next and bool(items)
+        self.items = items
+
+        self._column_key = column.key
+        self._id_key = id_column.key
+        self.prev_cursor = self._cursor(items[0]) if self.has_prev else None
+        self.next_cursor = self._cursor(items[-1]) if self.has_next else None
+
+    def _cursor(self, item):
+        return encode_cursor(getattr(item, self._column_key), getattr(item, self._id_key))
+
+
+def keyset_paginate(query, column, id_column, per_page, descending=True):
+    return KeysetPagination(query, column, id_column, per_page, after=request.args.get('after'),
+                            before=request.args.get('before'), descending=descending)
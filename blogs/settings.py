@@ -32,17 +32,50 @@ class BaseConfig(object):
     USERS_PER_PAGE = 20
 
     MAIL_SUBJECT_PREFIX = '[泰科论坛]'
+    MAIL_WORKERS = 2  # 发信线程数，每个线程保持一条 SMTP 连接；0 表示在请求里直接发送
+    MAIL_QUEUE_SIZE = 1000
+    MAIL_QUEUE_TIMEOUT = 5  # 队列满时最多等待的秒数，超时的邮件丢弃
+    MAIL_BATCH_SIZE = 50
+    MAIL_RETRIES = 3
+    MAIL_RETRY_BACKOFF = 1  # 第一次重试前等待的秒数，之后每次翻倍
+    MAIL_IDLE_TIMEOUT = 30  # 空闲这么多秒后关闭 SMTP 连接
+    NOTICE_DIGEST_WINDOW = 3600  # 汇总邮件合并多长时间（秒）内的新回帖；有用户选了汇总时 flask send-digests 需要由 cron 定时运行
+    SITE_URL = os.getenv('SITE_URL', 'http://localhost:5000')  # 命令行发送的邮件里生成链接用
+    # 未读通知数用 SSE 推送。每条连接在等待期间（最长 NOTIFY_STREAM_MAX_AGE 秒）占着一个请求线程，同步 worker
+    # 几个标签页就能占满，所以默认关闭、用轮询；只在 gevent 等协程 worker 下打开（gunicorn -k gevent，
+    # monkey patch 之后 threading.Event 的等待是协作式的）
+    NOTIFY_STREAM = False
+    # local 或 redis。local 只在本进程内广播，页面在推送之外仍然定期轮询；多进程部署时用 redis（需要安装 redis）
+    NOTIFY_BACKEND = os.getenv('NOTIFY_BACKEND', 'local')
+    NOTIFY_REDIS_URL = os.getenv('NOTIFY_REDIS_URL', 'redis://localhost:6379/0')
+    NOTIFY_REDIS_CHANNEL = 'forum:notification-count'
+    NOTIFY_STREAM_HEARTBEAT = 25  # 空闲连接发送保活注释的间隔（秒），要短于代理的读超时
+    NOTIFY_STREAM_MAX_AGE = 600  # 连接保持的最长时间（秒），之后浏览器自动重连
+    NOTIFY_STREAM_RETRY = 5  # 断开后浏览器重连前等待的秒数
 
     UPLOADS_DEFAULT_DEST = os.path.join(basedir, 'uploads')
     UPLOAD_PATH = os.path.join(UPLOADS_DEFAULT_DEST, 'files')
     TECON_PATH = os.path.join(UPLOADS_DEFAULT_DEST, 'tecon')
 
     AVATARS_SAVE_PATH = os.path.join(UPLOADS_DEFAULT_DEST, 'avatars')
+    IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # uuid 命名的上传文件在浏览器里缓存的时间
+    # 由前端 Nginx 发送文件时，上传目录配置项到 internal location 的映射，如 {'UPLOAD_PATH': '/_uploads/files'}
+    ACCEL_REDIRECT_LOCATIONS = {}
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local')  # local 或 s3，多台服务器共用上传文件时用 s3（需要安装 boto3）
+    STORAGE_S3_BUCKET = os.getenv('STORAGE_S3_BUCKET')
+    STORAGE_S3_ENDPOINT_URL = os.getenv('STORAGE_S3_ENDPOINT_URL')  # MinIO 等兼容服务的地址，AWS 留空
+    STORAGE_S3_REGION = os.getenv('STORAGE_S3_REGION')
+    STORAGE_S3_PRESIGNED = True  # 下载时重定向到预签名地址；False 时由应用转发文件内容
+    STORAGE_S3_URL_EXPIRES = 3600
     AVATARS_SIZE_TUPLE = (30, 60, 150)
+    AVATARS_CROP_BASE_WIDTH = 500
+    IMAGE_WORKERS = 2  # 图片处理进程数，0 表示在请求里同步处理
 
     PHOTO_SIZE = {'small': 300, 'medium':750}
+    # thumbnail，后缀不能为空：缩略图在后台生成，不能覆盖已经按 immutable 发出去的原图
     PHOTO_SUFFIX = {PHOTO_SIZE['small']: '_s',
-                    PHOTO_SIZE['medium']: ''}  # thumbnail
+                    PHOTO_SIZE['medium']: '_w%d' % PHOTO_SIZE['medium']}
+    IMAGE_VARIANT_WIDTHS = (320, 480)  # 正文图片另外生成的宽度，最宽的一张是 PHOTO_SIZE['medium']
 
     SECRET_KEY = os.getenv('SECRET_KEY', 'secret string')
 
@@ -57,6 +90,16 @@ class BaseConfig(object):
     MANAGE_NEWS_PER_PAGE = 20
     DELETED_PER_PAGE = 15
 
+    VIEW_COUNTER_FLUSH_INTERVAL = 30  # 浏览数缓冲写回数据库的间隔（秒）
+    READ_MARK_DAYS = 30  # 这么多天之前的动态一律算已读，已读记录只保存这段时间内的，flask prune-read-marks 定期清理
+    # memory 或 redis；memory 时每个进程各自缓冲、各自写回，redis 时所有进程共用（需要安装 redis）
+    VIEW_COUNTER_STORE = os.getenv('VIEW_COUNTER_STORE', 'memory')
+    VIEW_COUNTER_REDIS_URL = os.getenv('VIEW_COUNTER_REDIS_URL', 'redis://localhost:6379/0')
+    CONTEXT_CACHE_TIMEOUT = 300  # 多进程部署时其他进程的写入最多延迟这么久可见
+    FRAGMENT_CACHE_SIZE = 2000  # 片段缓存最多保存的片段数，0 表示关闭
+    PAGE_CACHE_SIZE = 500  # 游客整页缓存最多保存的页面数，0 表示关闭
+    PAGE_CACHE_TIMEOUT = 60  # 整页缓存的有效期（秒）
+
     WHOOSHEE_MIN_STRING_LEN = 2  #搜索限制字符设定
 
     CKEDITOR_FILE_UPLOADER = 'main.upload'
@@ -79,6 +122,8 @@ class DevelopmentConfig(BaseConfig):
 
 class TestingConfig(BaseConfig):
     TESTING = True
+    IMAGE_WORKERS = 0
+    MAIL_WORKERS = 0
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'      # in-memory database
 
@@ -48,22 +48,34 @@ $(function () {
         }, 3000);
     }
 
-    function update_notifications_count() {
+    function set_notifications_count(count) {
         var $el = $('#notification-badge');
+        if (count === 0) {
+            $el.hide();
+        } else {
+            $el.show();
+            $el.text(count)
+        }
+    }
+
+    function update_notifications_count() {
         $.ajax({
             type: 'GET',
-            url: $el.data('href'),
+            url: $('#notification-badge').data('href'),
             success: function (data) {
-                if (data.count === 0) {
-                    $('#notification-badge').hide();
-                } else {
-                    $el.show();
-                    $el.text(data.count)
-                }
+                set_notifications_count(data.count);
             }
         });
     }
 
+    // 服务器在未读数变化时推送，断开后浏览器自动重连
+    function watch_notifications_count() {
+        var source = new EventSource($('#notification-badge').data('stream'));
+        source.onmessage = function (e) {
+            set_notifications_count(parseInt(e.data, 10));
+        };
+    }
+
     var hover_timer = null;
 
     function show_profile_popover(e) {
@@ -120,7 +132,14 @@ $(function () {
     });
 
     if (is_authenticated) {
-        setInterval(update_notifications_count, 300000);
+        var streaming = window.EventSource && $('#notification-badge').data('stream');
+        if (streaming) {
+            watch_notifications_count();
+        }
+        // 推送只在本进程内广播时收不到别的进程里的变化，仍然定期轮询
+        if (!streaming || !$('#notification-badge').data('stream-shared')) {
+            setInterval(update_notifications_count, 300000);
+        }
     }
 
     $("[data-toggle='tooltip']").tooltip({title: moment($(this).data('timestamp')).format('lll')});
@@ -0,0 +1,367 @@
+import mimetypes
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from contextlib import contextmanager
+from hashlib import md5
+
+from flask import current_app, request, redirect, send_from_directory, make_response, Response, abort, safe_join
+from werkzeug.urls import url_quote
+
+# 上传文件的存取都经过这里。STORAGE_BACKEND 选择后端：local 存在本机目录，s3 存在 S3 兼容的对象存储，
+# 多台应用服务器部署时用 s3。数据库里只存文件名，文件按文件名哈希分两级子目录存放（ab/cd/<name>）。
+
+STORAGE_KEYS = ('UPLOAD_PATH', 'AVATARS_SAVE_PATH', 'TECON_PATH')
+PENDING_SUFFIX = '.pending'  # 缩略图生成期间放在目标文件旁边的标记，get_file 看到它就返回占位图
+CHUNK_SIZE = 64 * 1024
+
+# iter_files 列出的文件：文件名、修改时间（时间戳）、后端内部的位置（本地是绝对路径，S3 是对象键）
+StoredFile = namedtuple('StoredFile', ['filename', 'modified', 'location'])
+
+
+def shard(filename):
+    digest = md5(filename.encode('utf-8')).hexdigest()
+    return '/'.join([digest[:2], digest[2:4], filename])
+
+
+class LocalStorage(object):
+    """本机目录。分片之前上传的文件留在目录根下，migrate() 迁移完成之前两处都会查找。"""
+
+    def __init__(self, config):
+        self.roots = dict((path_key, config[path_key]) for path_key in STORAGE_KEYS)
+        self.accel_locations = config['ACCEL_REDIRECT_LOCATIONS']
+
+    def path_for(self, path_key, filename, create=False):
+        """文件在分片布局下的绝对路径，create=True 时顺便建好所在目录。"""
+        path = safe_join(self.roots[path_key], shard(filename))
+        if create:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def locate(self, path_key, filename):
+        """返回文件相对上传目录的实际位置：分片目录里有就用分片的，否则找还没迁移的旧位置；都没有返回 None。"""
+        # 迁移命令可能正在移动这个文件，旧位置之后再查一次分片位置
+        for relative in (shard(filename), filename, shard(filename)):
+            if os.path.isfile(safe_join(self.roots[path_key], relative)):
+                return relative
+        return None
+
+    def find(self, path_key, filename):
+        relative = self.locate(path_key, filename)
+        return safe_join(self.roots[path_key], relative) if relative else None
+
+    def exists(self, path_key, filename):
+        return self.locate(path_key, filename) is not None
+
+    def open(self, path_key, filename):
+        path = self.find(path_key, filename)
+        if path is None:
+            raise FileNotFoundError(filename)
+        return open(path, 'rb')
+
+    def temp_dir(self, path_key):
+        # 临时文件和目标放在同一个文件系统上，写完直接改名
+        return self.roots[path_key]
+
+    def save(self, path_key, filename, stream):
+        path = self.path_for(path_key, filename, create=True)
+        fd, temp_path = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(stream, f, CHUNK_SIZE)
+        os.replace(temp_path, path)
+
+    def save_file(self, path_key, filename, source):
+        """把本机文件 source 移进存储。"""
+        shutil.move(source, self.path_for(path_key, filename, create=True))
+
+    @contextmanager
+    def local_copy(self, path_key, filename):
+        yield self.find(path_key, filename)
+
+    def remove(self, path_key, filename):
+        path = self.find(path_key, filename)
+        if path is not None:
+            os.remove(path)
+
+    def mark_pending(self, path_key, filename):
+        open(self.path_for(path_key, filename, create=True) + PENDING_SUFFIX, 'w').close()
+
+    def clear_pending(self, path_key, filename):
+        path = self.path_for(path_key, filename) + PENDING_SUFFIX
+        if os.path.exists(path):
+            os.remove(path)
+
+    def is_pending(self, path_key, filename):
+        return os.path.exists(self.path_for(path_key, filename) + PENDING_SUFFIX)
+
+    def send_first(self, path_key, filenames):
+        """发送 filenames 里第一个存在的文件，返回 (文件名, 响应)；都不存在时返回 (None, None)。
+
+        ACCEL_REDIRECT_LOCATIONS 里配置了这个目录时交给 Nginx 用 X-Accel-Redirect 发送，否则由 Flask 发送。
+        """
+        for filename in filenames:
+            relative = self.locate(path_key, filename)
+            if relative is not None:
+                return filename, self._send(path_key, filename, relative)
+        return None, None
+
+    def _send(self, path_key, filename, relative):
+        location = self.accel_locations.get(path_key)
+        if location:
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = location.rstrip('/') + '/' + url_quote(relative)
+            response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            return response
+        return send_from_directory(self.roots[path_key], relative, cache_timeout=0)
+
+    def iter_files(self, path_key):
+        """逐个列出目录里的所有文件（包括临时文件和 .pending 标记），不会一次读进整个目录树。"""
+        stack = [self.roots[path_key]]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield StoredFile(entry.name, entry.stat().st_mtime, entry.path)
+
+    def discard(self, path_key, location):
+        try:
+            os.remove(location)
+        except FileNotFoundError:
+            pass
+
+    def unsharded_files(self, path_key):
+        with os.scandir(self.roots[path_key]) as entries:
+            for entry in entries:
+                # 点开头的是写入中的临时文件
+                if entry.is_file() and not entry.name.startswith('.') and not entry.name.endswith(PENDING_SUFFIX):
+                    yield entry.name
+
+    def migrate(self, path_key, batch_size=1000):
+        """把目录根下最多 batch_size 个旧文件移进分片目录，返回移动的个数；返回 0 说明已经迁移完。"""
+        moved = 0
+        for filename in self.unsharded_files(path_key):
+            if moved >= batch_size:
+                break
+            os.replace(safe_join(self.roots[path_key], filename), self.path_for(path_key, filename, create=True))
+            moved += 1
+        return moved
+
+
+class S3Storage(object):
+    """S3 兼容的对象存储（AWS S3、MinIO 等），需要安装 boto3。
+
+    对象键是 <前缀>/<分片路径>，前缀取本地配置目录的最后一级（files、avatars、tecon）。
+    STORAGE_S3_PRESIGNED 为 True 时下载请求重定向到预签名地址，否则由应用边读边转发。
+    """
+
+    def __init__(self, config):
+        self.bucket = config['STORAGE_S3_BUCKET']
+        self.endpoint_url = config['STORAGE_S3_ENDPOINT_URL']
+        self.region = config['STORAGE_S3_REGION']
+        self.presigned = config['STORAGE_S3_PRESIGNED']
+        self.url_expires = config['STORAGE_S3_URL_EXPIRES']
+        self.prefixes = dict((path_key, os.path.basename(config[path_key].rstrip(os.sep)))
+                             for path_key in STORAGE_KEYS)
+        self._client = None
+
+    def __getstate__(self):
+        # 图片处理进程里重新创建 client
+        state = self.__dict__.copy()
+        state['_client'] = None
+        return state
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError('STORAGE_BACKEND = "s3" requires boto3.')
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url, region_name=self.region)
+        return self._client
+
+    def key_for(self, path_key, filename):
+        return self.prefixes[path_key] + '/' + shard(filename)
+
+    def _head(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+    def exists(self, path_key, filename):
+        return self._head(self.key_for(path_key, filename)) is not None
+
+    def open(self, path_key, filename):
+        """下载到临时文件，小文件留在内存里；返回可以 seek 的文件对象。"""
+        from botocore.exceptions import ClientError
+        f = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        try:
+            self.client.download_fileobj(self.bucket, self.key_for(path_key, filename), f)
+        except ClientError:
+            f.close()
+            raise FileNotFoundError(filename)
+        f.seek(0)
+        return f
+
+    def temp_dir(self, path_key):
+        return None
+
+    def _extra_args(self, filename):
+        return {'ContentType': mimetypes.guess_type(filename)[0] or 'application/octet-stream'}
+
+    def save(self, path_key, filename, stream):
+        # upload_fileobj 分块上传，大文件不会整个读进内存
+        self.client.upload_fileobj(stream, self.bucket, self.key_for(path_key, filename),
+                                   ExtraArgs=self._extra_args(filename))
+
+    def save_file(self, path_key, filename, source):
+        self.client.upload_file(source, self.bucket, self.key_for(path_key, filename),
+                                ExtraArgs=self._extra_args(filename))
+        os.remove(source)
+
+    @contextmanager
+    def local_copy(self, path_key, filename):
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1])
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self.key_for(path_key, filename), path)
+            yield path
+        finally:
+            os.remove(path)
+
+    def remove(self, path_key, filename):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key_for(path_key, filename))
+
+    def mark_pending(self, path_key, filename):
+        self.client.put_object(Bucket=self.bucket, Key=self.key_for(path_key, filename) + PENDING_SUFFIX, Body=b'')
+
+    def clear_pending(self, path_key, filename):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key_for(path_key, filename) + PENDING_SUFFIX)
+
+    def is_pending(self, path_key, filename):
+        return self._head(self.key_for(path_key, filename) + PENDING_SUFFIX) is not None
+
+    def send_first(self, path_key, filenames):
+        """发送 filenames 里第一个存在的对象，返回 (文件名, 响应)；都不存在时返回 (None, None)。
+
+        存在的对象只用一次请求：转发时直接 GET，不存在才换下一个；预签名时 HEAD 一次确认存在。
+        """
+        for filename in filenames:
+            response = self._send(self.key_for(path_key, filename))
+            if response is not None:
+                return filename, response
+        return None, None
+
+    def _send(self, key):
+        from botocore.exceptions import ClientError
+        if self.presigned:
+            if self._head(key) is None:
+                return None
+            url = self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': key},
+                                                     ExpiresIn=self.url_expires)
+            response = redirect(url)
+            # 预签名地址会过期，重定向只能缓存到过期之前
+            response.cache_control.private = True
+            response.cache_control.max_age = self.url_expires // 2
+            return response
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError:
+            return None
+        body = obj['Body']
+        response = Response(body.iter_chunks(CHUNK_SIZE), mimetype=obj.get('ContentType'), direct_passthrough=True)
+        response.content_length = obj['ContentLength']
+        response.last_modified = obj['LastModified']
+        response.set_etag(obj['ETag'].strip('"'))
+        response.call_on_close(body.close)
+        return response.make_conditional(request)
+
+    def iter_files(self, path_key):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefixes[path_key] + '/'):
+            for obj in page.get('Contents', ()):
+                yield StoredFile(obj['Key'].rsplit('/', 1)[-1], obj['LastModified'].timestamp(), obj['Key'])
+
+    def discard(self, path_key, location):
+        self.client.delete_object(Bucket=self.bucket, Key=location)
+
+    def migrate(self, path_key, batch_size=1000):
+        return 0  # 对象键一开始就是分片的
+
+
+BACKENDS = {'local': LocalStorage, 's3': S3Storage}
+
+
+def init_app(app):
+    app.extensions['storage'] = BACKENDS[app.config['STORAGE_BACKEND']](app.config)
+
+
+def get_backend():
+    return current_app.extensions['storage']
+
+
+def exists(path_key, filename):
+    return get_backend().exists(path_key, filename)
+
+
+def open_file(path_key, filename):
+    return get_backend().open(path_key, filename)
+
+
+def save(path_key, filename, storage):
+    """保存上传的文件，storage 可以是 FileStorage 或任何可读的文件对象。"""
+    get_backend().save(path_key, filename, getattr(storage, 'stream', storage))
+
+
+def save_file(path_key, filename, source):
+    get_backend().save_file(path_key, filename, source)
+
+
+def temp_file(path_key, suffix=''):
+    """创建一个之后要交给 save_file 的临时文件，返回 (fd, path)。"""
+    return tempfile.mkstemp(prefix='.upload-', suffix=suffix, dir=get_backend().temp_dir(path_key))
+
+
+def adopt(path_key, filename):
+    """把别的代码（比如 Flask-Avatars）直接写在本地目录根下的文件移进存储。"""
+    source = safe_join(current_app.config[path_key], filename)
+    if os.path.isfile(source):
+        save_file(path_key, filename, source)
+
+
+def remove(path_key, filename):
+    get_backend().remove(path_key, filename)
+
+
+def send(path_key, filename):
+    filename, response = send_first(path_key, [filename])
+    if response is None:
+        abort(404)
+    return response
+
+
+def send_first(path_key, filenames):
+    return get_backend().send_first(path_key, filenames)
+
+
+def is_pending(path_key, filename):
+    return get_backend().is_pending(path_key, filename)
+
+
+def migrate(path_key, batch_size=1000):
+    return get_backend().migrate(path_key, batch_size)
+
+
+def iter_files(path_key):
+    return get_backend().iter_files(path_key)
+
+
+def discard(path_key, location):
+    get_backend().discard(path_key, location)
@@ -4,16 +4,22 @@ except ImportError:
     from urllib.parse import urlparse, urljoin
 
 import os
-import PIL
+import re
+import hashlib
+import time
 import uuid
-from PIL import Image
-from flask import request, redirect, url_for, current_app, flash
+from flask import request, redirect, url_for, current_app, flash, send_from_directory, abort
+from werkzeug.urls import url_quote, url_unquote
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from itsdangerous import BadSignature, SignatureExpired
+from sqlalchemy.exc import IntegrityError
 
 from blogs.settings import Operations
-from blogs.models.blogs import User
+from blogs.models.blogs import User, Blob, File, Topic, Post
+from blogs.models.tecon import Photo, Item
 from blogs.extensions import db
+from blogs.images import image_service, variant_name, VARIANT_FORMATS
+from blogs import storage
 
 
 def is_safe_url(target):
@@ -31,18 +37,198 @@ def redirect_back(default='main.index', **kwargs):
     return redirect(url_for(default, **kwargs))
 
 
-def resize_image(image, filename, base_width):
-    filename, ext = os.path.splitext(filename)
-    img = Image.open(image)
-    if img.size[0] <= base_width:
-        return filename + ext
-    w_percent = (base_width / float(img.size[0]))
-    h_size = int((float(img.size[1]) * float(w_percent)))
-    img = img.resize((base_width, h_size), PIL.Image.ANTIALIAS)
+IMAGE_EXTENSIONS = ['jpg', 'png', 'jpeg', 'gif', 'PNG', 'bmp']
+# uuid 或内容哈希命名（可带 _s/_m/_l 之类的后缀）的文件一经写入内容就不会再变
+CONTENT_ADDRESSED_FILENAME = re.compile(r'^[0-9a-f]{32}(_\w+)?\.\w+$')
 
-    filename += current_app.config['PHOTO_SUFFIX'][base_width] + ext
-    img.save(os.path.join(current_app.config['UPLOAD_PATH'], filename), optimize=True, quality=85)
-    return filename
+
+def send_upload(path_key, filename):
+    """发送 path_key 配置的上传目录里的文件，具体怎么发送由存储后端决定（见 storage.py）。
+
+    uuid 命名的文件让浏览器缓存一年且不再验证；用原文件名保存的附件删除后文件名可能被重用，
+    只带 ETag/Last-Modified，每次都向服务器验证。
+
+    对象存储上每次查询都是一次网络请求：文件存在时只发送一次，找不到时才查是不是还在生成。
+    """
+    negotiable = os.path.splitext(filename)[1][1:].lower() in VARIANT_FORMATS
+    candidates = [filename]
+    if negotiable and 'image/webp' in request.headers.get('Accept', ''):
+        # 浏览器明确支持 WebP（*/* 不算）并且有 WebP 版本时发送 WebP，地址不变
+        candidates.insert(0, variant_name(filename, ext='.webp'))
+    sent, response = storage.send_first(path_key, candidates)
+    if response is None:
+        if not storage.is_pending(path_key, filename):
+            abort(404)
+        # 缩略图还在后台生成，先返回占位图，不让浏览器缓存
+        response = send_from_directory(os.path.join(current_app.static_folder, 'imgs'), 'processing.png',
+                                       cache_timeout=0)
+        response.cache_control.no_cache = True
+        return response
+    if negotiable:
+        response.vary.add('Accept')
+    if response.location:  # 重定向到对象存储的预签名地址，缓存时间由后端决定
+        return response
+    if CONTENT_ADDRESSED_FILENAME.match(os.path.basename(sent)):
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % current_app.config['IMMUTABLE_MAX_AGE']
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def resize_image(filename, base_width, path_key='UPLOAD_PATH'):
+    # 缩放交给后台进程池，这里只读图片尺寸、算出缩略图文件名就返回
+    return image_service.resize(path_key, filename, base_width)
+
+
+def resize_variants(filename, path_key='UPLOAD_PATH'):
+    # 正文图片缩到 PHOTO_SIZE['medium']，另外生成 IMAGE_VARIANT_WIDTHS 里的窄版本和 WebP
+    return image_service.variants(path_key, filename, current_app.config['PHOTO_SIZE']['medium'],
+                                  current_app.config['IMAGE_VARIANT_WIDTHS'])
+
+
+def hash_file(stream, out=None, chunk_size=64 * 1024):
+    """分块读取 stream 计算 sha256，给了 out 就同时写进去，返回 (哈希, 字节数)。"""
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+        size += len(chunk)
+        if out is not None:
+            out.write(chunk)
+    return digest.hexdigest(), size
+
+
+def save_attachment(upload):
+    """边写盘边算哈希，内容相同的附件只保存一份，返回引用数已加一的 Blob。"""
+    ext = os.path.splitext(upload.filename)[1].lower()
+    fd, temp_path = storage.temp_file('UPLOAD_PATH', ext)
+    with os.fdopen(fd, 'wb') as f:
+        sha256, size = hash_file(upload.stream, f)
+
+    blob = Blob.query.filter_by(sha256=sha256).first()
+    if blob is None:
+        filename = sha256[:32] + ext
+        storage.save_file('UPLOAD_PATH', filename, temp_path)
+        blob = Blob(sha256=sha256, filename=filename, size=size, ref_count=1)
+        if ext[1:] in IMAGE_EXTENSIONS:
+            blob.filename_s = resize_image(filename, current_app.config['PHOTO_SIZE']['small'])
+        db.session.add(blob)
+        try:
+            db.session.flush()
+            return blob
+        except IntegrityError:  # 同样内容的文件刚被别的请求存进来
+            db.session.rollback()
+            blob = Blob.query.filter_by(sha256=sha256).one()
+    else:
+        os.remove(temp_path)
+    blob.ref_count = Blob.ref_count + 1
+    return blob
+
+
+def dedupe_attachments():
+    """给去重之前上传的附件补上 Blob，内容相同的合并成一份并删掉多余的文件，返回 (处理数, 删除数)。
+
+    每个附件单独提交，中断后重新运行会接着处理剩下的。
+    """
+    linked = removed = 0
+    file_ids = [file_id for file_id, in db.session.query(File.id).filter(File.blob_id == None).order_by(File.id)]
+    for file_id in file_ids:
+        file = File.query.get(file_id)
+        if not storage.exists('UPLOAD_PATH', file.filename):
+            continue
+        with storage.open_file('UPLOAD_PATH', file.filename) as f:
+            sha256, size = hash_file(f)
+        blob = Blob.query.filter_by(sha256=sha256).first()
+        if blob is None:
+            blob = Blob(sha256=sha256, filename=file.filename, filename_s=file.filename_s, size=size, ref_count=1)
+            db.session.add(blob)
+        else:
+            blob.ref_count = Blob.ref_count + 1
+            for filename in set([file.filename, file.filename_s]) - set([blob.filename, blob.filename_s, None]):
+                shared = File.query.filter(File.id != file.id, db.or_(File.filename == filename,
+                                                                      File.filename_s == filename)).count()
+                if not shared and storage.exists('UPLOAD_PATH', filename):
+                    storage.remove('UPLOAD_PATH', filename)
+                    removed += 1
+        file.name = file.name or file.filename
+        file.filename, file.filename_s, file.blob = blob.filename, blob.filename_s, blob
+        db.session.commit()
+        linked += 1
+    return linked, removed
+
+
+UPLOAD_URL = re.compile(r'(/tecon)?/uploads/([^"\'\s?#<>]+)')  # 正文里引用上传文件的地址
+
+
+def _body_references(path_key, filenames, chunk_size=100):
+    """filenames 里被主题、回帖或 tecon 条目正文引用到的文件。
+
+    先按文件名主干用 LIKE 找出可能引用它们的正文（主干相同也就覆盖了只在发送时按 Accept 选用的 .webp），
+    再用 UPLOAD_URL 确认；一条语句里的 LIKE 条件限制在 chunk_size 个文件名以内。
+    """
+    if path_key not in ('UPLOAD_PATH', 'TECON_PATH'):
+        return set()
+    wanted = set(filenames)
+    prefix = '/tecon/uploads/' if path_key == 'TECON_PATH' else '/uploads/'
+    stems = sorted(set(os.path.splitext(filename)[0] for filename in wanted))
+    found = set()
+    for i in range(0, len(stems), chunk_size):
+        needles = set()
+        for stem in stems[i:i + chunk_size]:
+            needles.update([stem, url_quote(stem)])
+        for model in (Topic, Post, Item):
+            query = db.session.query(model.body).filter(db.or_(*[model.body.like('%' + prefix + needle + '%')
+                                                                 for needle in needles]))
+            for body, in query.yield_per(1000):
+                for tecon, filename in UPLOAD_URL.findall(body):
+                    if ('TECON_PATH' if tecon else 'UPLOAD_PATH') == path_key:
+                        filename = url_unquote(filename)
+                        found.update(wanted & set([filename, variant_name(filename, ext='.webp')]))
+    return found
+
+
+def _referenced_filenames(path_key, filenames):
+    columns = {'UPLOAD_PATH': [File.filename, File.filename_s, Blob.filename, Blob.filename_s],
+               'AVATARS_SAVE_PATH': [User.avatar_s, User.avatar_m, User.avatar_l, User.avatar_raw],
+               'TECON_PATH': [Photo.filename, Photo.filename_s]}[path_key]
+    found = set()
+    for column in columns:
+        found.update(filename for filename, in db.session.query(column).filter(column.in_(filenames)))
+    return found
+
+
+def _orphans(path_key, batch):
+    # 写入中途留下的临时文件和处理失败留下的 .pending 标记，过了宽限期也当作垃圾
+    filenames = [stored.filename for stored in batch
+                 if not stored.filename.startswith('.') and not stored.filename.endswith(storage.PENDING_SUFFIX)]
+    referenced = _referenced_filenames(path_key, filenames) if filenames else set()
+    unreferenced = [filename for filename in filenames if filename not in referenced]
+    if unreferenced:
+        referenced.update(_body_references(path_key, unreferenced))
+    for stored in batch:
+        if stored.filename not in referenced:
+            yield stored
+
+
+def find_orphan_uploads(path_key, grace_period, batch_size=500):
+    """逐批扫描 path_key 下的文件，生成没有被数据库记录或正文引用、
+    且超过 grace_period 秒没有修改的文件（storage.StoredFile）。
+
+    每批只拿这一批文件名去查数据库和正文，内存里只有当前这一批，和文件总数无关；
+    代价是每批都要把可能引用它们的正文扫一遍。
+    """
+    deadline = time.time() - grace_period
+    batch = []
+    for stored in storage.iter_files(path_key):
+        if stored.modified >= deadline:
+            continue
+        batch.append(stored)
+        if len(batch) >= batch_size:
+            for orphan in _orphans(path_key, batch):
+                yield orphan
+            batch = []
+    for orphan in _orphans(path_key, batch):
+        yield orphan
 
 
 def generate_token(user, operation, expire_in=None, **kwargs):
@@ -87,11 +273,11 @@ def flash_errors(form):
                 getattr(form, field).label.text, error), 'danger')
 
 
-def rename_image(old_filename):
+def rename_image(old_filename, path_key='UPLOAD_PATH'):
     name, ext = os.path.splitext(old_filename)
     count = 0
     while True:
         count = count + 1
         filename = '%s_%d%s' % (name, count, ext)
-        if not os.path.exists(os.path.join(current_app.config['UPLOAD_PATH'], filename)):
+        if not storage.exists(path_key, filename):
             return filename
\ No newline at end of file
@@ -0,0 +1,131 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from blogs import create_app
+from blogs.caches import cache, fragment_cache, page_cache
+from blogs.counters import view_counter
+from blogs.extensions import db
+from blogs.models.blogs import Role, Status, User, Forum, Topic, Post
+from blogs.models.tecon import Series
+from blogs.settings import config, TestingConfig
+
+PASSWORD = '12345678'
+
+
+def make_app(tmp_path, **settings):
+    """临时目录里的测试应用，settings 覆盖 TestingConfig 里的配置，建好表和基础数据。"""
+    class Config(TestingConfig):
+        UPLOAD_PATH = str(tmp_path / 'files')
+        AVATARS_SAVE_PATH = str(tmp_path / 'avatars')
+        TECON_PATH = str(tmp_path / 'tecon')
+        WHOOSHEE_MEMORY_STORAGE = True
+        FRAGMENT_CACHE_SIZE = 0
+        PAGE_CACHE_SIZE = 0
+
+    for key, value in settings.items():
+        setattr(Config, key, value)
+    for path in (Config.UPLOAD_PATH, Config.AVATARS_SAVE_PATH, Config.TECON_PATH):
+        os.makedirs(path, exist_ok=True)
+    config['pytest'] = Config
+    app = create_app('pytest')
+    # 进程内缓存跨用例共用，每个用例都从空缓存开始
+    for c in (cache, fragment_cache, page_cache):
+        c.clear()
+    with app.app_context():
+        db.create_all()
+        Role.init_role()
+        Status.init_status()
+        Series.init_series()
+    return app
+
+
+def drop_app(app):
+    view_counter.store.drain()  # 没写回的浏览数不能留给下一个用例或退出时的 flush
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = make_app(tmp_path)
+    yield app
+    drop_app(app)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def make_user(username, role='管理员', confirmed=True):
+    user = User(username=username, name=username, email='%s@example.com' % username, confirmed=confirmed)
+    user.set_password(PASSWORD)
+    user.role = Role.query.filter_by(name=role).first()
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def make_group(admin, name='group', status_id=4):
+    group = Forum(name=name, intro=name, admin=admin, status_id=status_id)
+    db.session.add(group)
+    db.session.commit()
+    return group
+
+
+def make_site():
+    """管理员和三个游客可访问的小组；基础模板里要显示 3 号小组的信息。"""
+    admin = make_user('admin')
+    groups = [make_group(admin, 'group%d' % i) for i in range(1, 4)]
+    return admin, groups
+
+
+def make_topics(group, author, count, posts=0):
+    """在 group 里发 count 个主题，每个主题 posts 条回帖，返回主题列表。"""
+    start = datetime.utcnow() - timedelta(days=1)
+    topics = []
+    for i in range(count):
+        topic = Topic(name='topic %d' % i, body='body %d' % i, group=group, author=author,
+                      timestamp=start + timedelta(minutes=i))
+        db.session.add(topic)
+        for j in range(posts):
+            db.session.add(Post(title='post', body='reply %d' % j, topic=topic, author=author,
+                                timestamp=topic.timestamp + timedelta(seconds=j + 1)))
+        topic.post_count = posts
+        group.post_count = (group.post_count or 0) + posts
+        topics.append(topic)
+    db.session.commit()
+    return topics
+
+
+def login(client, username, password=PASSWORD):
+    return client.post('/auth/login', data=dict(username=username, password=password), follow_redirects=True)
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def __len__(self):
+        return len(self.statements)
+
+    def reset(self):
+        self.statements = []
+
+
+@pytest.fixture
+def queries(app):
+    """记录执行过的 SQL，len(queries) 是语句数。"""
+    counter = QueryCounter()
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', counter)
+    yield counter
+    event.remove(engine, 'before_cursor_execute', counter)
@@ -0,0 +1,59 @@
+import fakeredis
+import pytest
+
+from blogs.counters import view_counter, ViewCounter, RedisStore
+from blogs.models.blogs import Topic
+
+from conftest import make_site, make_topics
+
+
+@pytest.fixture
+def topics(app):
+    with app.app_context():
+        admin, (group, _, _) = make_site()
+        return [topic.id for topic in make_topics(group, admin, 2)]
+
+
+def read_times(topic_ids):
+    return [Topic.query.get(topic_id).read_time for topic_id in topic_ids]
+
+
+def test_views_are_buffered_and_flushed_in_one_update(app, client, queries, topics):
+    for topic_id in topics + topics[:1]:
+        client.get('/show_topic/%d' % topic_id)
+    with app.app_context():
+        assert read_times(topics) == [0, 0]
+        queries.reset()
+        assert view_counter.flush() == 2
+        assert [s for s in queries.statements if s.startswith('UPDATE')] == [
+            'UPDATE topic SET read_time=(topic.read_time + ?) WHERE topic.id = ?']
+        assert read_times(topics) == [2, 1]
+
+
+def test_redis_store_is_shared_between_processes(app, topics, monkeypatch):
+    server = fakeredis.FakeServer()
+
+    def store():
+        s = RedisStore('redis://')
+        s._client = fakeredis.FakeRedis(server=server)
+        return s
+
+    # 两个 web 进程各自累加，命令行进程统一写回
+    web1, web2 = ViewCounter(store=store()), ViewCounter(store=store())
+    web1.incr(topics[0])
+    web2.incr(topics[0])
+    web2.incr(topics[1])
+    monkeypatch.setattr(view_counter, 'store', store())
+    result = app.test_cli_runner().invoke(args=['flush-view-counts'])
+    assert result.exit_code == 0, result.output
+    assert 'of 2 topics' in result.output
+    with app.app_context():
+        assert read_times(topics) == [2, 1]
+    assert web1.store.drain() == {}
+
+
+def test_flush_command_refuses_the_memory_store(app):
+    result = app.test_cli_runner().invoke(args=['flush-view-counts'])
+    assert result.exit_code != 0
+    assert 'VIEW_COUNTER_STORE' in result.output
+
@@ -0,0 +1,61 @@
+import logging
+import time
+
+import pytest
+
+from blogs.events import NotificationHub, RedisBackend
+
+from conftest import make_app, drop_app, make_site, login
+
+CONFIG = dict(NOTIFY_REDIS_URL='redis://localhost:6379/0', NOTIFY_REDIS_CHANNEL='test:notification-count')
+
+
+def redis_hub(fakeredis, server):
+    """一个"进程"里的 hub：各自的 RedisBackend 和连接，共用同一个（假的）Redis 服务器。"""
+    hub = NotificationHub()
+    hub.backend = RedisBackend(CONFIG)
+    hub.backend._client = fakeredis.FakeRedis(server=server)
+    hub.logger = logging.getLogger(__name__)
+    return hub
+
+
+def test_redis_backend_reaches_other_processes():
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    web1, web2 = redis_hub(fakeredis, server), redis_hub(fakeredis, server)
+    subscription = web2.subscribe(7)
+    # 接收线程订阅频道之前发布的消息会丢，等它订阅上
+    deadline = time.time() + 5
+    while not web1.backend.client.pubsub_numsub(CONFIG['NOTIFY_REDIS_CHANNEL'])[0][1] and time.time() < deadline:
+        time.sleep(0.01)
+
+    web1.publish(7, 3)
+    assert subscription.get(timeout=5) == 3
+    web1.publish(8, 1)  # 别的用户的数不会发给这条连接
+    assert subscription.get(timeout=0.2) is None
+
+
+def badge(client):
+    html = client.get('/').get_data(as_text=True)
+    start = html.index('id="notification-badge"')
+    return html[start:html.index('>', start)]
+
+
+@pytest.mark.parametrize('settings, stream, shared', [
+    (dict(), False, False),
+    (dict(NOTIFY_STREAM=True), True, False),
+    (dict(NOTIFY_STREAM=True, NOTIFY_BACKEND='redis'), True, True),
+])
+def test_badge_keeps_polling_unless_the_backend_is_shared(tmp_path, settings, stream, shared):
+    app = make_app(tmp_path, **settings)
+    try:
+        with app.app_context():
+            make_site()
+        client = app.test_client()
+        login(client, 'admin')
+        attrs = badge(client)
+        assert ('data-stream=' in attrs, 'data-stream-shared' in attrs) == (stream, shared)
+        if not stream:  # 关掉推送时连接也不能挂住请求线程
+            assert client.get('/ajax/notifications-stream').status_code == 404
+    finally:
+        drop_app(app)
@@ -0,0 +1,45 @@
+import io
+import os
+
+from blogs import storage
+from blogs.extensions import db
+from blogs.models.blogs import File, Post
+from blogs.models.tecon import Item
+from blogs.utils import find_orphan_uploads
+
+from conftest import make_site, make_topics
+
+
+def store(path_key, *filenames):
+    for filename in filenames:
+        storage.save(path_key, filename, io.BytesIO(b'data'))
+
+
+def orphans(path_key, batch_size=2):
+    # 刚写的文件都还在宽限期里，先把修改时间调回一天前
+    for stored in storage.iter_files(path_key):
+        os.utime(stored.location, (stored.modified - 86400, stored.modified - 86400))
+    return sorted(stored.filename for stored in find_orphan_uploads(path_key, 3600, batch_size))
+
+
+def test_orphans_are_found_batch_by_batch(app):
+    with app.app_context():
+        admin, groups = make_site()
+        topic, = make_topics(groups[0], admin, 1)
+        topic.body = '<p><a href="/uploads/report.pdf">report</a></p>'
+        db.session.add(Post(title='post', body='<img src="/uploads/%E5%9B%BE.png" '
+                                               'srcset="/uploads/pic_w320.jpg 320w">',
+                            topic=topic, author=admin))
+        db.session.add(Item(name='item', body='<img src="/tecon/uploads/banner.jpg">'))
+        db.session.add(File(name='a.zip', filename='attach.zip'))
+        db.session.commit()
+
+        store('UPLOAD_PATH', 'report.pdf', '图.png', '图.webp', 'pic_w320.jpg', 'pic_w320.webp',
+              'attach.zip', 'banner.jpg', 'report_old.pdf', 'lost.jpg', '.upload-tmp')
+        store('TECON_PATH', 'banner.jpg', 'banner.webp', 'report.pdf')
+
+        # 只在发送时选用的 .webp 和 srcset 里的缩小版本跟着引用它们的正文保留
+        assert orphans('UPLOAD_PATH') == ['.upload-tmp', 'banner.jpg', 'lost.jpg', 'report_old.pdf']
+        assert orphans('TECON_PATH') == ['report.pdf']
+        assert orphans('UPLOAD_PATH', batch_size=500) == ['.upload-tmp', 'banner.jpg', 'lost.jpg',
+                                                          'report_old.pdf']
@@ -0,0 +1,58 @@
+import io
+
+from PIL import Image
+
+from blogs import storage
+from blogs.images import responsive_images
+
+
+def image_bytes(width, height, fmt):
+    buf = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(buf, fmt)
+    return buf.getvalue()
+
+
+def upload(client, data, name):
+    response = client.post('/upload', data={'upload': (io.BytesIO(data), name)},
+                           content_type='multipart/form-data')
+    return response.get_json()
+
+
+def read(app, filename):
+    with app.app_context(), storage.open_file('UPLOAD_PATH', filename) as f:
+        return f.read()
+
+
+def width_of(app, filename):
+    return Image.open(io.BytesIO(read(app, filename))).size[0]
+
+
+def test_gif_thumbnail_does_not_replace_the_original(app, client):
+    original = image_bytes(1000, 500, 'GIF')
+    result = upload(client, original, 'wide.gif')
+    source = result['filename'].replace('_w750', '')
+    assert result['filename'] != source and result['url'].endswith(result['filename'])
+
+    # 原图一直保持上传时的内容，可以放心地按 immutable 缓存；正文引用的是另存的缩略图
+    assert read(app, source) == original
+    assert width_of(app, result['filename']) == 750
+    response = client.get('/uploads/' + source)
+    assert response.data == original and 'immutable' in response.headers['Cache-Control']
+
+
+def test_variants_leave_the_original_untouched(app, client):
+    original = image_bytes(1200, 600, 'JPEG')
+    source = upload(client, original, 'wide.jpg')['filename']
+    assert read(app, source) == original
+
+    master = source.replace('.jpg', '_w750.jpg')
+    assert width_of(app, master) == 750
+    assert [width_of(app, source.replace('.jpg', '_w%d.jpg' % w)) for w in (320, 480)] == [320, 480]
+    assert width_of(app, master.replace('.jpg', '.webp')) == 750
+
+    # 正文的 src 还是原图，srcset 里最宽的是缩小的版本，支持 srcset 的浏览器不会下载原图
+    with app.test_request_context():
+        html = responsive_images('<img src="/uploads/%s">' % source)
+    srcset = html.split('srcset=')[1]
+    assert '/uploads/%s 750w' % master in srcset and '/uploads/%s ' % source not in srcset
+    assert 'sizes="(max-width: 750px) 100vw, 750px"' in html
@@ -0,0 +1,121 @@
+import socket
+
+import pytest
+
+aiosmtpd = pytest.importorskip('aiosmtpd.controller')
+
+from flask_mail import Message
+
+from datetime import timedelta
+
+from blogs.emails import mail_queue
+from blogs.extensions import db
+from blogs.models.blogs import Notice, User
+
+from conftest import make_app, drop_app, make_site, make_topics, make_user
+
+
+class Inbox(object):
+    def __init__(self):
+        self.recipients = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.recipients.extend(envelope.rcpt_tos)
+        return '250 OK'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def inbox():
+    inbox = Inbox()
+    controller = aiosmtpd.Controller(inbox, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    yield inbox, controller.port
+    controller.stop()
+
+
+@pytest.fixture
+def app(tmp_path, inbox):
+    app = make_app(tmp_path, MAIL_SERVER='127.0.0.1', MAIL_PORT=inbox[1], MAIL_USE_SSL=False, MAIL_USERNAME=None,
+                   MAIL_PASSWORD=None, MAIL_DEFAULT_SENDER='forum@example.com', MAIL_SUPPRESS_SEND=False,
+                   MAIL_WORKERS=1, MAIL_RETRY_BACKOFF=0)
+    yield app
+    mail_queue.shutdown()
+    drop_app(app)
+
+
+def counts(*names):
+    stats = mail_queue.stats()  # 发信队列是进程里共用的，统计从之前的用例累计下来
+    return tuple(stats[name] for name in names)
+
+
+def message(to):
+    return Message('hello', recipients=[to], body='hello')
+
+
+def test_queue_delivers_over_one_connection(app, inbox):
+    before = counts('sent', 'failed', 'connections')
+    with app.app_context():
+        for i in range(5):
+            mail_queue.send(message('user%d@example.com' % i))
+    mail_queue.shutdown()
+    assert sorted(inbox[0].recipients) == ['user%d@example.com' % i for i in range(5)]
+    after = counts('sent', 'failed', 'connections')
+    assert tuple(a - b for a, b in zip(after, before)) == (5, 0, 1)
+
+
+def test_bad_message_fails_alone_and_keeps_the_worker(app, inbox):
+    before = counts('sent', 'failed')
+    with app.app_context():
+        mail_queue.send(message('first@example.com'))
+        mail_queue.send(message('bad\nheader@example.com'))  # flask_mail 抛 BadHeaderError
+        mail_queue.send(message('last@example.com'))
+    mail_queue.shutdown()
+    assert inbox[0].recipients == ['first@example.com', 'last@example.com']
+    after = counts('sent', 'failed')
+    assert tuple(a - b for a, b in zip(after, before)) == (2, 1)
+
+
+def subscribe_digest(username, email, topic):
+    user = make_user(username)
+    user.email, user.notice_email = email, 'digest'
+    db.session.add(Notice(noticed=topic, receiver=user, timestamp=topic.timestamp - timedelta(hours=1)))
+    db.session.commit()
+    return user.id
+
+
+def watermarks():
+    return dict((notice.receiver.username, notice.last_emailed) for notice in Notice.query)
+
+
+def test_digests_advance_only_for_delivered_mail(app, inbox):
+    # 发信线程开着也不用队列：命令直接发送，只给发出去的推进水位
+    with app.app_context():
+        admin, (group, _, _) = make_site()
+        topic, = make_topics(group, admin, 1, posts=2)
+        last_post = max(post.timestamp for post in topic.posts)
+        subscribe_digest('good', 'good@example.com', topic)
+        subscribe_digest('bad', 'bad\nheader@example.com', topic)  # 发送时抛 BadHeaderError
+
+    result = app.test_cli_runner().invoke(args=['send-digests'])
+    assert 'Sent 1 digests.' in result.output
+    assert inbox[0].recipients == ['good@example.com']
+    with app.app_context():
+        assert watermarks() == {'good': last_post, 'bad': None}
+
+    # 没发出去的下次再发，已经发过的不重复
+    result = app.test_cli_runner().invoke(args=['send-digests'])
+    assert 'Sent 0 digests.' in result.output and inbox[0].recipients == ['good@example.com']
+
+
+def test_new_and_existing_users_get_instant_emails(app):
+    with app.app_context():
+        # 加列之前就有的用户：由数据库的默认值填上
+        db.session.execute("INSERT INTO \"user\" (username, email) VALUES ('old', 'old@example.com')")
+        assert User.query.filter_by(username='old').one().notice_email == 'instant'
+        assert make_user('new').notice_email == 'instant'
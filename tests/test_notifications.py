@@ -0,0 +1,132 @@
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from blogs import noticifations
+from blogs.extensions import db
+from blogs.models.blogs import Notification, User
+
+from conftest import make_user, make_site, make_topics
+
+
+def add_notifications(user, unread, read=0):
+    for i in range(unread + read):
+        db.session.add(Notification(kind='legacy', message='n%d' % i, receiver=user, is_read=i >= unread))
+    user.unread_notification_count = unread
+    db.session.commit()
+
+
+def test_delete_notification_counts_only_unread_rows(app):
+    with app.app_context():
+        user = make_user('user')
+        add_notifications(user, unread=2, read=1)
+        unread, _, read = Notification.query.order_by(Notification.id).all()
+
+        user.delete_notification(read)
+        assert User.query.get(user.id).unread_notification_count == 2
+        user.delete_notification(unread)
+        assert User.query.get(user.id).unread_notification_count == 1
+        assert Notification.query.count() == 1
+
+
+def test_delete_notification_twice_decrements_once(app):
+    with app.app_context():
+        user = make_user('user')
+        add_notifications(user, unread=1)
+        notification_id = Notification.query.one().id
+        # 两个请求各自加载了同一条通知，再先后删除
+        first, second = Notification.query.get(notification_id), Notification(id=notification_id, is_read=False)
+        user.delete_notification(first)
+        user.delete_notification(second)
+        assert User.query.get(user.id).unread_notification_count == 0
+        assert Notification.query.count() == 0
+
+
+def unread_rows(user):
+    return [(n.kind, n.topic_id, n.count, n.is_read) for n in Notification.query.filter_by(receiver_id=user.id).
+            order_by(Notification.id)]
+
+
+def test_events_on_one_object_coalesce_while_unread(app):
+    with app.app_context():
+        admin, (group, _, _) = make_site()
+        topic, = make_topics(group, admin, 1)
+        reader, other = make_user('reader'), make_user('other')
+        noticifations.push_collect_notification(topic, reader)
+        noticifations.push_collect_notification(topic, other)
+        noticifations.push_notice_notification(topic, reader)
+        assert unread_rows(admin) == [('collect', topic.id, 2, False), ('notice', topic.id, 1, False)]
+        assert User.query.get(admin.id).unread_notification_count == 2
+
+        admin.read_all_notifications()
+        noticifations.push_collect_notification(topic, reader)  # 已读的那条不再合并，另起一条未读的
+        assert [row[2:] for row in unread_rows(admin)] == [(2, True), (1, True), (1, False)]
+
+
+def test_unread_key_is_unique(app):
+    with app.app_context():
+        user = make_user('user')
+        key = Notification.unread_key_for(user.id, 'collect', topic_id=1)
+        db.session.add_all([Notification(kind='collect', receiver=user, unread_key=key),
+                            Notification(kind='collect', receiver=user, unread_key=key)])
+        with pytest.raises(IntegrityError):
+            db.session.commit()
+
+
+def test_concurrent_first_events_leave_one_unread_row(app, monkeypatch):
+    with app.app_context():
+        admin, (group, _, _) = make_site()
+        topic, = make_topics(group, admin, 1)
+        reader = make_user('reader')
+        noticifations.push_collect_notification(topic, reader)
+
+        # 模拟另一个请求：它的 INSERT 在本请求的 UPDATE 之后才提交，本请求的 UPDATE 没有命中
+        coalesce, missed = noticifations._coalesce, []
+
+        def racing(key, actor):
+            if not missed:
+                missed.append(key)
+                return 0
+            return coalesce(key, actor)
+        monkeypatch.setattr(noticifations, '_coalesce', racing)
+        noticifations.push_collect_notification(topic, reader)
+        assert unread_rows(admin) == [('collect', topic.id, 2, False)]
+        assert User.query.get(admin.id).unread_notification_count == 1
+
+
+@pytest.mark.parametrize('message, fields', [
+    ('您发布的这个<a href="/show_topic/7">t</a>有新的回帖。', dict(kind='post', topic_id=7)),
+    ('您发表的<a href="/show_topic/7">t</a>已被<a href="/user/bob">bob</a>收藏。',
+     dict(kind='collect', topic_id=7, actor_username='bob')),
+    ('您发布的<a href="/show_topic/7">t</a>已被<a href="/user/bob">bob</a>订阅。',
+     dict(kind='notice', topic_id=7, actor_username='bob')),
+    ('您发布的<a href="/post/9">p</a>被举报已达上限，<a href="/post/9/edit">编辑</a>？',
+     dict(kind='reported_post', post_id=9)),
+    ('您发布的<a href="/show_topic/7">t</a>被举报已达上限，<a href="/topic/7/edit">编辑</a>？',
+     dict(kind='reported_topic', topic_id=7)),
+    ('您已被设为 <a href="/group/3">g</a> 小组的管理员。', dict(kind='group_admin', group_id=3)),
+    ('欢迎加入泰科论坛', dict(kind='legacy')),
+])
+def test_parse_legacy_message(message, fields):
+    assert Notification._parse_message(message) == fields
+
+
+def test_coalesce_all_merges_duplicates_and_fills_unread_keys(app):
+    with app.app_context():
+        admin, (group, _, _) = make_site()
+        topic, = make_topics(group, admin, 1)
+        # 转换出来的旧通知：同一主题上两条未读、两条已读的收藏通知，外加一条无法转换的
+        for is_read in (False, False, True, True):
+            db.session.add(Notification(kind='collect', topic_id=topic.id, receiver=admin, is_read=is_read))
+        db.session.add(Notification(kind='legacy', message='hi', receiver=admin))
+        db.session.commit()
+
+        assert Notification.coalesce_all() == 2
+        rows = Notification.query.order_by(Notification.id).all()
+        assert [(n.kind, n.count, n.is_read) for n in rows] == [('collect', 2, False), ('collect', 2, True),
+                                                                 ('legacy', 1, False)]
+        assert [n.unread_key for n in rows] == [Notification.unread_key_for(admin.id, 'collect', topic.id), None, None]
+        assert User.query.get(admin.id).unread_notification_count == 2
+
+        # 补上 unread_key 之后，新的事件合并进转换来的那条
+        noticifations.push_collect_notification(topic, make_user('reader'))
+        assert Notification.query.get(rows[0].id).count == 3
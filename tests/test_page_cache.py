@@ -0,0 +1,48 @@
+import pytest
+
+from blogs.caches import cache
+from blogs.extensions import db
+from blogs.models.blogs import Forum
+
+from conftest import make_app, drop_app, make_site, login
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = make_app(tmp_path, PAGE_CACHE_SIZE=10)
+    yield app
+    drop_app(app)
+
+
+def etag_of(client):
+    response = client.get('/')
+    assert response.status_code == 200
+    return response.headers['ETag']
+
+
+def test_private_etag_survives_a_process_restart(app, client):
+    with app.app_context():
+        make_site()
+    login(client, 'admin')
+    etag = etag_of(client)
+    assert client.get('/', headers={'If-None-Match': etag}).status_code == 304
+
+    # 新进程里内存的版本号从 0 开始，内容没变，ETag 也不变
+    cache._versions.clear()
+    assert etag_of(client) == etag
+
+
+def test_private_etag_changes_with_persisted_state(app, client):
+    with app.app_context():
+        make_site()
+    login(client, 'admin')
+    etag = etag_of(client)
+
+    with app.app_context():
+        Forum.query.get(1).intro = 'changed'
+        db.session.commit()
+    # 另一个进程的写入：本进程的版本号没动，靠数据库里的 version 列发现变化
+    cache._versions.clear()
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
@@ -0,0 +1,63 @@
+from blogs.extensions import db
+from blogs.models.blogs import Permission, User
+
+from conftest import make_user, make_site, make_topics, login
+
+
+def permission_queries(queries):
+    return [s for s in queries.statements if 'permission' in s.lower()]
+
+
+def test_can_is_an_in_memory_bit_test(app, queries):
+    with app.app_context():
+        admin = make_user('admin')
+        member = make_user('member', role='员工')
+        queries.reset()
+        assert admin.can('ADMINISTER') and admin.can('MEMBER')
+        assert member.can('MEMBER') and not member.can('MODERATE')
+        assert not member.can('NO_SUCH_PERMISSION')
+        assert not permission_queries(queries)
+
+
+def test_role_edit_rebuilds_masks(app):
+    with app.app_context():
+        member = make_user('member', role='员工')
+        assert not member.can('MODERATE')
+        role = member.role
+        role.permissions.append(Permission.query.filter_by(name='MODERATE').one())
+        db.session.commit()
+        assert User.query.get(member.id).can('MODERATE')
+
+
+def test_group_page_queries_do_not_grow_with_topics(app, client, queries):
+    with app.app_context():
+        admin, (small, large, _) = make_site()
+        make_topics(small, admin, 2, posts=1)
+        make_topics(large, admin, app.config['TOPIC_PER_PAGE'], posts=1)
+        small_id, large_id = small.id, large.id
+    login(client, 'admin')
+
+    counts = []
+    for group_id in (small_id, large_id):
+        queries.reset()
+        assert client.get('/group/%d' % group_id).status_code == 200
+        assert not permission_queries(queries)
+        counts.append(len(queries))
+    assert counts[0] == counts[1]
+
+
+def test_topic_page_queries_do_not_grow_with_posts(app, client, queries):
+    with app.app_context():
+        admin, (group, _, _) = make_site()
+        few, = make_topics(group, admin, 1, posts=2)
+        many, = make_topics(group, admin, 1, posts=app.config['POST_PER_PAGE'])
+        topic_ids = few.id, many.id
+    login(client, 'admin')
+
+    counts = []
+    for topic_id in topic_ids:
+        queries.reset()
+        assert client.get('/show_topic/%d' % topic_id).status_code == 200
+        assert not permission_queries(queries)
+        counts.append(len(queries))
+    assert counts[0] == counts[1]
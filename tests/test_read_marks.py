@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+
+from blogs.extensions import db
+from blogs.models.blogs import User, Topic, Post, ReadMark, GroupReadMark, View
+
+from conftest import make_site, make_topics
+
+
+def setup_group(count=3, posts=1):
+    admin, (group, _, _) = make_site()
+    topics = make_topics(group, admin, count, posts=posts)
+    return admin, group, topics
+
+
+def marks(user):
+    return sorted(topic_id for topic_id, in db.session.query(ReadMark.topic_id).filter_by(user_id=user.id))
+
+
+def test_topic_activity_follows_published_posts(app):
+    with app.app_context():
+        admin, group, (topic,) = setup_group(1, posts=2)
+        last = Post.query.filter_by(topic_id=topic.id).order_by(Post.timestamp.desc()).first()
+        assert Topic.query.get(topic.id).last_activity == last.timestamp
+        db.session.add(Post(title='draft', body='x', topic=topic, author=admin, saved=True,
+                            timestamp=datetime.utcnow()))
+        db.session.commit()
+        assert Topic.query.get(topic.id).last_activity == last.timestamp
+
+
+def test_reading_in_order_keeps_only_the_group_watermark(app):
+    with app.app_context():
+        admin, group, topics = setup_group()
+        for topic in topics:
+            admin.read(topic)
+        assert marks(admin) == []
+        assert GroupReadMark.query.get((admin.id, group.id)).timestamp == topics[-1].activity
+        assert all(is_read for is_read, _ in admin.read_states([t.id for t in topics]).values())
+
+
+def test_reads_above_an_unread_topic_are_kept_as_exceptions(app):
+    with app.app_context():
+        admin, group, (old, middle, new) = setup_group()
+        admin.read(new)
+        admin.read(middle)
+        assert marks(admin) == [middle.id, new.id]
+        assert not admin.is_reading(old) and admin.is_reading(new)
+
+        admin.read(old)  # 最早的未读主题读完，水位越过全部三个主题
+        assert marks(admin) == []
+        assert GroupReadMark.query.get((admin.id, group.id)).timestamp == new.activity
+
+
+def test_new_replies_are_counted_since_the_last_visit(app):
+    with app.app_context():
+        admin, group, topics = setup_group()
+        for topic in topics:
+            admin.read(topic)
+        topic = topics[1]
+        for i in range(2):
+            db.session.add(Post(title='new', body='new', topic=topic, author=admin))
+        db.session.commit()
+        topic = Topic.query.get(topic.id)
+        assert admin.read_states([topic.id]) == {topic.id: (False, 2)}
+        admin.read(topic)
+        assert admin.read_states([topic.id]) == {topic.id: (True, 0)}
+
+
+def test_reading_a_read_topic_does_not_write_or_aggregate(app, queries):
+    with app.app_context():
+        admin, group, topics = setup_group()
+        admin.read(topics[-1])
+        user, topic = User.query.get(admin.id), Topic.query.get(topics[-1].id)
+        queries.reset()
+        user.read(topic)
+        assert len(queries) <= 2  # 组水位和例外记录各一次主键查询
+        assert not [s for s in queries.statements if not s.startswith('SELECT') or 'count(' in s.lower()]
+
+
+def test_old_activity_counts_as_read(app):
+    with app.app_context():
+        admin, group, (topic,) = setup_group(1, posts=0)
+        topic.timestamp = datetime.utcnow() - timedelta(days=app.config['READ_MARK_DAYS'] + 1)
+        Topic.query.filter_by(id=topic.id).update({'last_activity': topic.timestamp})
+        db.session.commit()
+        assert admin.is_reading(Topic.query.get(topic.id))
+        assert admin.read_states([topic.id])[topic.id] == (True, 0)
+
+
+def test_convert_views_keeps_read_state_without_stamping_now(app):
+    with app.app_context():
+        admin, group, (old, middle, new) = setup_group()
+        reader, user_id, group_id, ids = User.query.get(admin.id), admin.id, group.id, [t.id for t in (old, middle, new)]
+        activities = [t.activity for t in (old, middle, new)]
+        # 旧版的数据：只有 View 记录，主题还没有 last_activity
+        Topic.query.update({'last_activity': None})
+        db.session.add_all([View(reader=reader, readed=old), View(reader=reader, readed=new)])
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['convert-views'])
+        assert 'Converted 2' in result.output
+        assert View.query.count() == 0
+        # old 并入组水位，new 上面还有一个没读过的 middle，留作例外，位置是它当时的动态时间
+        assert GroupReadMark.query.get((user_id, group_id)).timestamp == activities[0]
+        assert [(m.topic_id, m.timestamp) for m in ReadMark.query.all()] == [(ids[2], activities[2])]
+        states = User.query.get(user_id).read_states(ids)
+        assert [states[topic_id][0] for topic_id in ids] == [True, False, True]
+
+
+def test_prune_removes_marks_older_than_the_horizon(app):
+    with app.app_context():
+        admin, group, topics = setup_group()
+        user_id, topic_ids = admin.id, [t.id for t in topics]
+        stale = datetime.utcnow() - timedelta(days=app.config['READ_MARK_DAYS'] + 1)
+        db.session.add_all([ReadMark(user_id=user_id, topic_id=topic_id, timestamp=stale) for topic_id in topic_ids[:2]] +
+                           [ReadMark(user_id=user_id, topic_id=topic_ids[2]),
+                            GroupReadMark(user_id=user_id, group_id=group.id, timestamp=stale)])
+        db.session.commit()
+        result = app.test_cli_runner().invoke(args=['prune-read-marks', '--batch-size', '1'])
+        assert 'Pruned 3' in result.output
+        assert marks(User.query.get(user_id)) == [topic_ids[2]]
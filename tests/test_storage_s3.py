@@ -0,0 +1,107 @@
+import io
+
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+from blogs import storage
+
+from conftest import make_app, drop_app, make_site
+
+# moto 5 把各服务的 mock 合并成 mock_aws；Pipfile 要求的 Python 3.7 上最高只能装 moto 4，用 mock_s3
+mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_s3
+
+BUCKET = 'forum-uploads'
+NAME = 'ab' * 16 + '.jpg'  # uuid 命名，可以按 immutable 缓存
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for key, value in [('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                       ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(key, value)
+    with mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        yield
+
+
+def s3_app(tmp_path, presigned):
+    return make_app(tmp_path, STORAGE_BACKEND='s3', STORAGE_S3_BUCKET=BUCKET, STORAGE_S3_REGION='us-east-1',
+                    STORAGE_S3_PRESIGNED=presigned)
+
+
+class Calls(object):
+    """记下 S3 client 发出的请求（操作名）。"""
+
+    def __init__(self, backend):
+        self.names = []
+        backend.client.meta.events.register('before-call.s3', self)
+
+    def __call__(self, model, **kwargs):
+        self.names.append(model.name)
+
+
+@pytest.fixture
+def app(tmp_path, s3):
+    app = s3_app(tmp_path, presigned=False)
+    yield app
+    drop_app(app)
+
+
+def test_backend_round_trip(app):
+    with app.app_context():
+        storage.save('UPLOAD_PATH', NAME, io.BytesIO(b'jpeg'))
+        assert storage.exists('UPLOAD_PATH', NAME)
+        with storage.open_file('UPLOAD_PATH', NAME) as f:
+            assert f.read() == b'jpeg'
+        assert [stored.filename for stored in storage.iter_files('UPLOAD_PATH')] == [NAME]
+
+        storage.get_backend().mark_pending('UPLOAD_PATH', 'thumb.jpg')
+        assert storage.is_pending('UPLOAD_PATH', 'thumb.jpg')
+        storage.get_backend().clear_pending('UPLOAD_PATH', 'thumb.jpg')
+        assert not storage.is_pending('UPLOAD_PATH', 'thumb.jpg')
+
+        storage.remove('UPLOAD_PATH', NAME)
+        assert not storage.exists('UPLOAD_PATH', NAME)
+
+
+def test_send_upload_makes_one_request(app, client):
+    with app.app_context():
+        storage.save('UPLOAD_PATH', NAME, io.BytesIO(b'jpeg'))
+        storage.save('UPLOAD_PATH', NAME.replace('.jpg', '.webp'), io.BytesIO(b'webp'))
+        calls = Calls(storage.get_backend())
+
+    response = client.get('/uploads/' + NAME, headers={'Accept': 'image/webp,*/*'})
+    assert response.data == b'webp' and 'immutable' in response.headers['Cache-Control']
+    assert calls.names == ['GetObject']
+
+    calls.names = []
+    response = client.get('/uploads/' + NAME)
+    assert response.data == b'jpeg' and calls.names == ['GetObject']
+
+
+def test_missing_upload_checks_pending_marker(app, client):
+    with app.app_context():
+        make_site()  # 404 页面要显示 3 号小组
+        storage.get_backend().mark_pending('UPLOAD_PATH', NAME)
+        calls = Calls(storage.get_backend())
+    response = client.get('/uploads/' + NAME)
+    assert response.status_code == 200 and response.cache_control.no_cache
+    assert calls.names == ['GetObject', 'HeadObject']
+    with app.app_context():
+        storage.get_backend().clear_pending('UPLOAD_PATH', NAME)
+    assert client.get('/uploads/' + NAME).status_code == 404
+
+
+def test_presigned_redirect_makes_one_head(tmp_path, s3):
+    app = s3_app(tmp_path, presigned=True)
+    try:
+        with app.app_context():
+            storage.save('UPLOAD_PATH', NAME, io.BytesIO(b'jpeg'))
+            calls = Calls(storage.get_backend())
+        response = app.test_client().get('/uploads/' + NAME)
+        assert response.status_code == 302 and BUCKET in response.location
+        assert calls.names == ['HeadObject']
+    finally:
+        drop_app(app)